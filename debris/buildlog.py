@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""debris.buildlog -- compressed on-disk build logs for debris."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import lzma
+import os
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import common
+from .common import getconfig
+from .common import log
+
+"bytes of log tail kept in the db as error excerpt."
+EXCERPT_SIZE = 4096
+
+"read size used when decompressing."
+READ_SIZE = 65536
+
+
+class BuildLog(object):
+    """A compressed build log that is written incrementally.
+
+    Output is compressed as it comes in; nothing but the last few KiB is
+    kept in memory. Once `max_size` uncompressed bytes have been written,
+    the middle of the log is dropped and only the last `tail_size` bytes
+    are appended on close(), after a marker line.
+
+    Can be passed to run_process() as `logfile`.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            compression: str = None,
+            max_size: int = None,
+            tail_size: int = None,
+            ):
+        if compression is None:
+            compression = getconfig('DEBRIS_LOG_COMPRESSION')
+        if max_size is None:
+            max_size = getconfig('DEBRIS_LOG_MAX_SIZE', int)
+        if tail_size is None:
+            tail_size = getconfig('DEBRIS_LOG_TAIL_SIZE', int)
+        if compression == 'zstd' and zstandard is None:
+            log.warn('python3-zstandard not available, falling back to xz logs.')
+            compression = 'xz'
+        if compression not in ('zstd', 'xz'):
+            raise Exception('ERR_UNKNOWN_LOG_COMPRESSION')
+        self.compression = compression
+        self.path = '{}.{}'.format(path, 'zst' if compression == 'zstd' else 'xz')
+        self.max_size = max_size
+        self.tail_size = tail_size
+        self.size = 0
+        self.omitted = 0
+        self._tail = bytearray()
+        self._excerpt = bytearray()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        log.debug('opening build log: {}'.format(self.path))
+        if compression == 'zstd':
+            self._fh = zstandard.ZstdCompressor().stream_writer(open(self.path, 'wb'))
+        else:
+            self._fh = lzma.open(self.path, 'wb')
+
+    @classmethod
+    def for_build(cls, package: str, version: str, chroot: str):
+        """Create a log under DEBRIS_LOG_DIR for one build attempt."""
+        _local_name = '{}_{}_{}_{}.log'.format(
+                package,
+                version.replace(':', '%'),
+                chroot,
+                time.strftime('%Y%m%dT%H%M%S'),
+                )
+        return cls(os.path.join(getconfig('DEBRIS_LOG_DIR'), package, _local_name))
+
+    @staticmethod
+    def _keep_last(buf: bytearray, data: bytes, size: int):
+        buf += data
+        if len(buf) > size:
+            del buf[:len(buf) - size]
+
+    def write(self, data: bytes):
+        self._keep_last(self._excerpt, data, EXCERPT_SIZE)
+        _local_room = max(0, self.max_size - self.size)
+        if _local_room:
+            self._fh.write(data[:_local_room])
+        _local_over = data[_local_room:]
+        if _local_over:
+            self._keep_last(self._tail, _local_over, self.tail_size)
+            self.omitted += len(_local_over)
+        self.size += len(data)
+
+    def close(self):
+        if self._fh is None:
+            return
+        if self.omitted:
+            _local_omitted = self.omitted - len(self._tail)
+            if _local_omitted > 0:
+                self._fh.write('\n[debris: log exceeded {} bytes, {} bytes omitted]\n'.format(
+                        self.max_size,
+                        _local_omitted).encode())
+            self._fh.write(bytes(self._tail))
+        self._fh.close()
+        self._fh = None
+
+    @property
+    def excerpt(self) -> str:
+        """The last lines of output, for a quick look at why a build failed."""
+        _local_text = bytes(self._excerpt).decode('utf-8', errors='replace')
+        if len(self._excerpt) >= EXCERPT_SIZE and '\n' in _local_text:
+            "drop the partial first line."
+            _local_text = _local_text.split('\n', 1)[1]
+        return _local_text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def open_log(path: str):
+    """Open a compressed build log for binary reading."""
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise Exception('ERR_ZSTANDARD_NOT_AVAILABLE')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return lzma.open(path, 'rb')
+
+def iter_log_lines(path: str):
+    """Yield lines of a build log one by one, without loading all of it."""
+    with open_log(path) as f:
+        _local_rest = b''
+        while True:
+            _local_chunk = f.read(READ_SIZE)
+            if not _local_chunk:
+                break
+            _local_lines = (_local_rest + _local_chunk).split(b'\n')
+            _local_rest = _local_lines.pop()
+            for i in _local_lines:
+                yield i.decode('utf-8', errors='replace') + '\n'
+        if _local_rest:
+            yield _local_rest.decode('utf-8', errors='replace')
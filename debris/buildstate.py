@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""debris.buildstate -- per-chroot build state and build input fingerprints."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import hashlib
+
+from . import common
+from . import git
+from . import sbuild
+from .common import getconfig
+from .common import log
+
+"known parts of DEBRIS_BUILD_FINGERPRINT."
+FINGERPRINT_COMPONENTS = ('source', 'chroot', 'extra_repo')
+
+
+class BuildState(object):
+    """Decide which (package, chroot) pairs need building.
+
+    Every build of a package version in a chroot is recorded with a
+    fingerprint of its inputs, made of the parts listed in
+    DEBRIS_BUILD_FINGERPRINT:
+
+      * 'source': the commit sha of the package repo;
+      * 'chroot': the toolchain packages of the chroot, see
+        SBInstance.get_package_set_hash();
+      * 'extra_repo': the versions of the build dependencies the extra
+        repository has (see debris.sbuild.get_extra_repo_packages())
+        and, with DEBRIS_LOCALREPO, of those built by debris itself.
+
+    A pair needs building unless the db has a successful build of the
+    same version in that chroot with the same fingerprint. Versions
+    marked built before builds were recorded per chroot count as built
+    in every chroot.
+
+    The package set of each chroot is looked up once, after any
+    pending upgrade of it (see SBInstance.get_package_set_hash()); so
+    upgrade chroots before creating a BuildState, not during its use.
+    Builds on remote workers are recorded with the package set of the
+    local chroot too, as that is what the next run compares against.
+    """
+
+    def __init__(self, db, instances: list, pkglist: list):
+        """Load the build state of pkglist in the given SBInstances from db."""
+        self.db = db
+        self.instances = instances
+        self.components = getconfig('DEBRIS_BUILD_FINGERPRINT', list)
+        for i in self.components:
+            if i not in FINGERPRINT_COMPONENTS:
+                raise Exception('ERR_UNKNOWN_DEBRIS_BUILD_FINGERPRINT')
+        self._builtset = db.get_chroot_builtset()
+        self._legacy = db.get_legacy_builtset()
+        self._pkgrepos = dict([(i.package, i) for i in pkglist])
+        self._extra_repo = {}
+        self._deps = {}
+        self._chroot_parts = {}
+        if 'extra_repo' in self.components:
+            if getconfig('DEBRIS_LOCALREPO') == "yes":
+                _local_graph = git.DebrisRepo.get_build_dependency_graph(pkglist)
+                for k, v in _local_graph.items():
+                    self._deps[k] = sorted(['{}={}'.format(d, self._pkgrepos[d].version) for d in v])
+
+    @staticmethod
+    def _get_sha(pkgrepo) -> str:
+        if pkgrepo.sha is None:
+            pkgrepo.sha = pkgrepo.repo.head.commit.hexsha
+        return pkgrepo.sha
+
+    def _get_chroot_part(self, instance) -> str:
+        if instance.chroot not in self._chroot_parts:
+            _local_package_set = instance.get_package_set_hash()
+            if _local_package_set is None:
+                log.warn('toolchain of {} unknown, it does not count for its fingerprints.'.format(instance.chroot))
+                _local_package_set = ''
+            self._chroot_parts[instance.chroot] = _local_package_set
+        return self._chroot_parts[instance.chroot]
+
+    def _get_extra_repo_part(self, pkgrepo, instance) -> str:
+        if instance.arch not in self._extra_repo:
+            self._extra_repo[instance.arch] = sbuild.get_extra_repo_packages(instance.arch)
+            if self._extra_repo[instance.arch] is None:
+                log.warn('extra repository of {} unknown, it does not count for its fingerprints.'.format(instance.arch))
+                self._extra_repo[instance.arch] = {}
+        _local_packages = self._extra_repo[instance.arch]
+        if not _local_packages:
+            return ''
+        pkgrepo.load_control()
+        return ','.join(sorted(['{}={}'.format(i, _local_packages[i]) for i in pkgrepo.build_depends if i in _local_packages]))
+
+    def get_fingerprint(self, pkgrepo, instance) -> str:
+        """Return the fingerprint of building pkgrepo in instance right now."""
+        _local_parts = [pkgrepo.package, pkgrepo.version]
+        if 'source' in self.components:
+            _local_parts.append('source={}'.format(self._get_sha(pkgrepo)))
+        if 'chroot' in self.components:
+            _local_parts.append('chroot={}'.format(self._get_chroot_part(instance)))
+        if 'extra_repo' in self.components:
+            _local_parts.append('extra_repo={}'.format(self._get_extra_repo_part(pkgrepo, instance)))
+            _local_parts.append('deps={}'.format(','.join(self._deps.get(pkgrepo.package, []))))
+        return hashlib.sha256('\n'.join(_local_parts).encode()).hexdigest()
+
+    def get_todo_chroots(self, pkgrepo) -> list:
+        """Return the chroots where pkgrepo needs building.
+
+        A package with only arch:all binaries is only built where
+        SBInstance.arch_all is set.
+        """
+        if (pkgrepo.package, pkgrepo.version) in self._legacy:
+            return []
+        _local_todo = []
+        for i in self.instances:
+            if not i.arch_all:
+                pkgrepo.load_control()
+                if pkgrepo.arch_all_only:
+                    continue
+            if (pkgrepo.package, pkgrepo.version, i.chroot, self.get_fingerprint(pkgrepo, i)) not in self._builtset:
+                _local_todo.append(i.chroot)
+        return _local_todo
+
+    def needs_build(self, pkgrepo) -> bool:
+        """True if pkgrepo needs building in any chroot."""
+        return bool(self.get_todo_chroots(pkgrepo))
+
+    def get_todo(self, pkgrepos: list) -> dict:
+        """Map the package of each given PkgRepo to the chroots where it needs building.
+
+        Packages that need no building are left out.
+
+        :example::
+            {'nixnote2': ['stretch-i386-sbuild']}
+        """
+        todo = {}
+        for i in pkgrepos:
+            _local_chroots = self.get_todo_chroots(i)
+            if _local_chroots:
+                todo[i.package] = _local_chroots
+        return todo
+
+    def mark_built(self, package: str, instance):
+        """Record a successful build of package in instance, with the current fingerprint."""
+        _local_pkgrepo = self._pkgrepos[package]
+        _local_fingerprint = self.get_fingerprint(_local_pkgrepo, instance)
+        self.db.mark_chroot_built(_local_pkgrepo.package, _local_pkgrepo.version, instance.chroot, _local_fingerprint)
+        self._builtset.add((_local_pkgrepo.package, _local_pkgrepo.version, instance.chroot, _local_fingerprint))
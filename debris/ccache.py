@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""debris.ccache -- persistent compiler caches for sbuild chroots."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import os
+import subprocess
+import uuid
+
+from . import common
+from . import sbuild
+from .common import run_process
+from .common import getconfig
+from .common import log
+
+"where the cache of a chroot shows up inside it."
+CHROOT_MOUNT_BASE = '/var/cache/debris-ccache'
+
+"fstab of the sbuild schroot profile; the overlay backend extends it."
+SBUILD_PROFILE_FSTAB = '/etc/schroot/sbuild/fstab'
+
+"relative setup.fstab paths of schroot are relative to this."
+SCHROOT_CONF_BASE = '/etc/schroot'
+
+"per-build stats logs, inside the cache."
+STATSLOG_DIR = 'statslog'
+
+"lines of a ccache stats log that count as hits and misses."
+STATSLOG_HITS = ('direct_cache_hit', 'preprocessed_cache_hit')
+STATSLOG_MISSES = ('cache_miss',)
+
+
+class CCache(object):
+    """The persistent ccache of one suite/arch.
+
+    The cache lives in DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE/ccache/
+    <suite>-<arch> and is bind-mounted at CHROOT_MOUNT_BASE/<suite>-<arch>
+    inside the chroot. For the overlay backend debris does that itself,
+    see write_fstab(); for the schroot backend, add
+
+        <base>/ccache  /var/cache/debris-ccache  none  rw,bind  0  0
+
+    to the fstab of the chroot, usually /etc/schroot/sbuild/fstab;
+    without it, see has_mount(), the instance does not use ccache.
+
+    sbuild reads the generated config in self.sbuildrc, which reads
+    ~/.sbuildrc first, then puts /usr/lib/ccache first in PATH and sets
+    CCACHE_DIR. Each build gets its own config on top of that, see
+    start_build(), so that its hits and misses are counted apart from
+    concurrent builds in the cache. ccache itself comes in as an extra
+    build dependency, see get_sbuild_options(). The size limit is
+    DEBRIS_CCACHE_MAXSIZE, kept by ccache itself.
+    """
+
+    def __init__(self, suite: str, arch: str):
+        self.name = '{}-{}'.format(suite, arch)
+        self.base = os.path.join(getconfig('DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE'), 'ccache')
+        self.path = os.path.join(self.base, self.name)
+        self.chroot_path = os.path.join(CHROOT_MOUNT_BASE, self.name)
+        self.sbuildrc = os.path.join(self.base, '{}.sbuildrc'.format(self.name))
+        self.fstab = os.path.join(self.base, '{}.fstab'.format(self.name))
+
+    def setup(self):
+        """Create the cache dir, and write its ccache.conf and sbuildrc."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except PermissionError:
+            "the base dir belongs to root; the cache must be writable by the build user."
+            run_process(sbuild.get_privileged_command(['mkdir', '-p', self.path]))
+            run_process(sbuild.get_privileged_command(['chown', '{}:{}'.format(os.getuid(), os.getgid()), self.base, self.path]))
+        os.makedirs(os.path.join(self.path, STATSLOG_DIR), exist_ok=True)
+        "written by the build user of the chroot."
+        os.chmod(os.path.join(self.path, STATSLOG_DIR), 0o1777)
+        with open(os.path.join(self.path, 'ccache.conf'), 'w') as f:
+            f.write('# written by debris, see DEBRIS_CCACHE_MAXSIZE.\n')
+            f.write('max_size = {}\n'.format(getconfig('DEBRIS_CCACHE_MAXSIZE')))
+            f.write('umask = 002\n')
+        with open(self.sbuildrc, 'w') as f:
+            f.write('\n'.join([
+                    '# written by debris for {}, do not edit.'.format(self.name),
+                    '# sbuild does not read ~/.sbuildrc if SBUILD_CONFIG is set; read it here.',
+                    'if (-r "$ENV{HOME}/.sbuildrc") {',
+                    '    eval `cat "$ENV{HOME}/.sbuildrc"`;',
+                    '    die $@ if $@;',
+                    '}',
+                    "$build_environment = { %{$build_environment // {}}, 'CCACHE_DIR' => '" + self.chroot_path + "' };",
+                    "$path = '/usr/lib/ccache:' . ($path // '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin');",
+                    '1;',
+                    '',
+                    ]))
+        log.debug('ccache of {} set up in {}.'.format(self.name, self.path))
+
+    def write_fstab(self) -> str:
+        """Write an fstab for schroot setup.fstab: the sbuild profile plus the cache.
+
+        Return its path, or None if the sbuild profile has no fstab.
+        """
+        try:
+            with open(SBUILD_PROFILE_FSTAB) as f:
+                _local_fstab = f.read()
+        except OSError as e:
+            log.error('cannot read {}, building in {} without ccache: {}.'.format(SBUILD_PROFILE_FSTAB, self.name, str(e)))
+            return None
+        if not _local_fstab.endswith('\n'):
+            _local_fstab += '\n'
+        _local_fstab += '{} {} none rw,bind 0 0\n'.format(self.path, self.chroot_path)
+        subprocess.run(
+                sbuild.get_privileged_command(['tee', self.fstab]),
+                input=_local_fstab.encode(),
+                stdout=subprocess.DEVNULL,
+                check=True,
+                )
+        return self.fstab
+
+    def has_mount(self, chroot: str) -> bool:
+        """Whether the fstab of the schroot chroot bind-mounts the cache."""
+        try:
+            result = run_process(['schroot', '--config', '--chroot={}'.format(chroot)], 60)
+        except Exception as e:
+            log.warn('cannot read the schroot config of {}: {}.'.format(chroot, str(e)))
+            return False
+        _local_config = {}
+        for i in result.stdout.decode(errors='replace').splitlines():
+            if '=' in i:
+                _local_config[i.split('=', 1)[0].strip()] = i.split('=', 1)[1].strip()
+        _local_fstab = _local_config.get('setup.fstab')
+        if not _local_fstab:
+            _local_fstab = os.path.join(_local_config.get('profile', 'default'), 'fstab')
+        _local_fstab = os.path.join(SCHROOT_CONF_BASE, _local_fstab)
+        _local_mounts = ((self.base, CHROOT_MOUNT_BASE), (self.path, self.chroot_path))
+        try:
+            with open(_local_fstab) as f:
+                for i in f:
+                    _local_fields = i.split()
+                    if len(_local_fields) < 2 or _local_fields[0].startswith('#'):
+                        continue
+                    if (os.path.realpath(_local_fields[0]), os.path.normpath(_local_fields[1])) in [(os.path.realpath(j), k) for j, k in _local_mounts]:
+                        return True
+        except OSError as e:
+            log.warn('cannot read {}: {}.'.format(_local_fstab, str(e)))
+        return False
+
+    def start_build(self) -> str:
+        """Write the sbuild config of one build, return its path; see finish_build()."""
+        _local_id = uuid.uuid4().hex
+        _local_sbuildrc = os.path.join(self.base, '{}.{}.sbuildrc'.format(self.name, _local_id))
+        with open(_local_sbuildrc, 'w') as f:
+            f.write('\n'.join([
+                    '# written by debris for one build in {}, do not edit.'.format(self.name),
+                    "do '" + self.sbuildrc + "';",
+                    'die $@ if $@;',
+                    "$build_environment = { %{$build_environment // {}}, 'CCACHE_STATSLOG' => '" + '/'.join([self.chroot_path, STATSLOG_DIR, _local_id]) + "' };",
+                    '1;',
+                    '',
+                    ]))
+        return _local_sbuildrc
+
+    def finish_build(self, sbuildrc: str) -> dict:
+        """Remove the config from start_build(), return the hits and misses of that build.
+
+        Return None if ccache logged nothing, e.g. for a build without
+        compiling, or with a ccache too old for CCACHE_STATSLOG.
+
+        :example::
+            {'hits': 1520, 'misses': 87}
+        """
+        _local_id = os.path.basename(sbuildrc)[len(self.name) + 1:-len('.sbuildrc')]
+        _local_statslog = os.path.join(self.path, STATSLOG_DIR, _local_id)
+        try:
+            os.unlink(sbuildrc)
+        except OSError:
+            pass
+        try:
+            with open(_local_statslog) as f:
+                _local_lines = [i.strip() for i in f]
+            os.unlink(_local_statslog)
+        except OSError:
+            return None
+        return dict(
+                hits=len([i for i in _local_lines if i in STATSLOG_HITS]),
+                misses=len([i for i in _local_lines if i in STATSLOG_MISSES]),
+                )
@@ -3,11 +3,13 @@
 # debris.common -- common things for debris autobuild system
 
 import ast
+import io
 import os
 import configparser
 import subprocess
 import logging
 import fcntl
+import threading
 
 def get_log_verbosity(offset: int, base=2):
     """Get logging verbosity according to verbosity offset.
@@ -93,16 +95,75 @@ def getconfig(config_key: str, returntype: type = str):
     """
     BUILTIN_CONFIG = {
             'DEBRIS_DB_FILE' : '/var/cache/debris/history.db',
+            'DEBRIS_DB_BATCH_SIZE' : 32,
+            'DEBRIS_DB_BATCH_INTERVAL' : 10,
+            'DEBRIS_DB_HISTORY_DAYS' : 365,
+            'DEBRIS_DB_HISTORY_KEEP' : 10,
+            'DEBRIS_DB_COMPACT_DAYS' : 30,
             'DEBRIS_SBUILD_MIRRORURI' : 'http://ftp2.cn.debian.org/debian',
             'DEBRIS_SBUILD_EXTRAURI' : 'http://repo.debiancn.org/',
             'DEBRIS_SBUILD_USE_EXTRA_REPO' : 'no',
+            'DEBRIS_SBUILD_EXTRA_REPO' : '',
+            'DEBRIS_SBUILD_EXTRA_REPO_KEY' : '',
             'DEBRIS_SBUILD_OUTPUTDIR' : '/var/cache/debris/output/',
             'DEBRIS_SBUILD_CHROOT_ARCH' : ['amd64',],
             'DEBRIS_SBUILD_CHROOT_SUITE' : ['stretch',],
             'DEBRIS_SBUILD_CHROOT_SUFFIX' : 'sbuild',
             'DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE': '/var/cache/debris/',
+            'DEBRIS_SBUILD_PREPARE_WORKERS' : 2,
+            'DEBRIS_SBUILD_APT_PROXY' : '',
+            'DEBRIS_SBUILD_UPGRADE_MIN_INTERVAL' : 0,
+            'DEBRIS_SBUILD_CHROOT_BACKEND' : 'schroot',
+            'DEBRIS_SBUILD_OVERLAY_DIR' : '/dev/shm/debris-overlay',
+            'DEBRIS_SBUILD_SCHROOT_CONF_DIR' : '/etc/schroot/chroot.d',
+            'DEBRIS_CCACHE' : 'no',
+            'DEBRIS_CCACHE_MAXSIZE' : '5G',
             'DEBRIS_GIT_REPO_URL' : 'https://github.com/debiancn/repo',
             'DEBRIS_GIT_REPO_LOCAL' : '/home/hosiet/src/debian/repo',
+            'DEBRIS_GIT_FETCH_WORKERS' : 8,
+            'DEBRIS_GIT_FETCH_TIMEOUT' : 300,
+            'DEBRIS_GIT_CLONE_MODE' : 'shared',
+            'DEBRIS_BUILD_ROOT' : '',
+            'DEBRIS_BUILD_PIPELINE' : 'dsc',
+            'DEBRIS_BUILD_FINGERPRINT' : ['source'],
+            'DEBRIS_BUILD_TIMEOUT' : 6 * 3600,
+            'DEBRIS_BUILD_TIMEOUT_FACTOR' : 3,
+            'DEBRIS_BUILD_TIMEOUT_SAMPLES' : 3,
+            'DEBRIS_BUILD_TIMEOUT_MIN' : 1800,
+            'DEBRIS_BUILD_TIMEOUT_MAX' : 24 * 3600,
+            'DEBRIS_BUILD_MEMORY_LIMIT' : 0,
+            'DEBRIS_BUILD_CPU_LIMIT' : 'no',
+            'DEBRIS_BUILD_CGROUP' : 'auto',
+            'DEBRIS_ORIGCACHE_DIR' : '',
+            'DEBRIS_ORIGCACHE_SIZE' : 20 * 1024 * 1024 * 1024,
+            'DEBRIS_LOCALREPO' : 'no',
+            'DEBRIS_LOCALREPO_DIR' : '',
+            'DEBRIS_LOCALREPO_URI' : '',
+            'DEBRIS_WORKSPACE_PERSISTENT' : 'no',
+            'DEBRIS_WORKSPACE_DISK_BUDGET' : 0,
+            'DEBRIS_WORKSPACE_WORKERS' : 4,
+            'DEBRIS_SCHEDULER_WORKERS' : 1,
+            'DEBRIS_SCHEDULER_CHROOT_LIMIT' : 0,
+            'DEBRIS_SCHEDULER_CPU_BUDGET' : 0,
+            'DEBRIS_SCHEDULER_MEMORY_BUDGET' : 0,
+            'DEBRIS_SCHEDULER_JOB_CPUS' : 1,
+            'DEBRIS_SCHEDULER_JOB_MEMORY' : 0,
+            'DEBRIS_SCHEDULER_COST_ALPHA' : 0.3,
+            'DEBRIS_SCHEDULER_DEFAULT_COST' : 1800,
+            'DEBRIS_METRICS_SUMMARY' : '',
+            'DEBRIS_METRICS_TEXTFILE' : '',
+            'DEBRIS_LOG_STREAMING' : 'yes',
+            'DEBRIS_LOG_DIR' : '/var/cache/debris/log/',
+            'DEBRIS_LOG_COMPRESSION' : 'zstd',
+            'DEBRIS_LOG_MAX_SIZE' : 256 * 1024 * 1024,
+            'DEBRIS_LOG_TAIL_SIZE' : 4 * 1024 * 1024,
+            'DEBRIS_DAEMON_SOCKET' : '/var/cache/debris/control.sock',
+            'DEBRIS_DAEMON_POLL_INTERVAL' : 900,
+            'DEBRIS_REMOTE_LISTEN' : '',
+            'DEBRIS_REMOTE_COORDINATOR' : '',
+            'DEBRIS_REMOTE_SECRET_FILE' : '/etc/debris/remote.secret',
+            'DEBRIS_REMOTE_WAIT_TIMEOUT' : 600,
+            'DEBRIS_REMOTE_WORKER_SLOTS' : 1,
             }
 
     # TODO: load config file here
@@ -131,7 +192,7 @@ class DebrisGlobalLock(object):
             fcntl.lockf(self.f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
         except OSError:
             "Yes, locked by others. Give up."
-            raise DebrisInstanceLockedError('fcntl locking failed, path {}, pid {}.'.format(self.lockfile, self.f.read()))
+            raise self.DebrisInstanceLockedError('fcntl locking failed, path {}, pid {}.'.format(self.lockfile, self.f.read()))
         self.f.write(str(os.getpid()))
         self.f.seek(0)
         pass
@@ -141,23 +202,114 @@ class DebrisGlobalLock(object):
         fcntl.lockf(self.f.fileno(), fcntl.LOCK_UN)
         self.f.close()
 
-def run_process(arglist, timeout=None, check=True) -> subprocess.CompletedProcess:
+def _wait_rusage(p: subprocess.Popen) -> int:
+    """
+    Reap p with os.wait4() instead of p.wait(), return its peak RSS in KiB.
+
+    The peak covers p and every descendant it waited for, so for a build
+    it is the RSS of the largest process in the build.
+    """
+    _local_pid, _local_status, _local_rusage = os.wait4(p.pid, 0)
+    if os.WIFSIGNALED(_local_status):
+        p.returncode = -os.WTERMSIG(_local_status)
+    else:
+        p.returncode = os.WEXITSTATUS(_local_status)
+    return _local_rusage.ru_maxrss
+
+def _run_process_logged(arglist, logfile, timeout=None, cwd=None, limits=None) -> subprocess.CompletedProcess:
+    """
+    Like subprocess.run(), but stream stdout and stderr into logfile.
+
+    Output is read in chunks and handed to logfile.write() as it comes,
+    so it is never held in memory as a whole.
+
+    With `limits` (a debris.limits.BuildLimits), the process runs in its
+    own process group (and cgroup, if possible) with those limits, and
+    its whole tree is stopped on expiry.
+    """
+    reaped = threading.Event()
+    if limits is not None:
+        timeout = limits.timeout or timeout
+        p = subprocess.Popen(
+                limits.wrap(arglist),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                cwd=cwd,
+                start_new_session=True,
+                )
+        limits.apply(p)
+    else:
+        p = subprocess.Popen(
+                arglist,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                cwd=cwd,
+                )
+    expired = threading.Event()
+    def _kill():
+        expired.set()
+        if limits is not None:
+            limits.kill(p, reaped)
+        else:
+            p.kill()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill)
+        timer.start()
+    try:
+        for chunk in iter(lambda: p.stdout.read1(65536), b''):
+            logfile.write(chunk)
+        max_rss = _wait_rusage(p)
+        reaped.set()
+    finally:
+        p.stdout.close()
+        if timer:
+            timer.cancel()
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(arglist, timeout)
+    result = subprocess.CompletedProcess(arglist, p.returncode)
+    result.max_rss = max_rss
+    return result
+
+def run_process(arglist, timeout=None, check=True, cwd=None, logfile=None, limits=None) -> subprocess.CompletedProcess:
     """
     Wrapper for subprocess.run()
 
+    Give `cwd` instead of calling os.chdir(), so that concurrent builds
+    do not fight over the process-wide working directory.
+
+    With `logfile` given (e.g. a debris.buildlog.BuildLog), stdout and
+    stderr are streamed into it, and the result holds neither. The result
+    then also has `max_rss`, the peak RSS in KiB; without logfile it is
+    None.
+
+    With `limits` (a debris.limits.BuildLimits), see _run_process_logged();
+    its timeout takes precedence.
+
     Require python 3.5+
     """
     try:
-        log.debug('executing subprocess: {}, timeout {}.'.format(
+        log.debug('executing subprocess: {}, timeout {}, cwd {}.'.format(
                 str(arglist),
-                timeout))
-        result = subprocess.run(
-                arglist,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=timeout,
-                check=False,
-                );
+                timeout,
+                cwd))
+        if logfile is not None:
+            result = _run_process_logged(arglist, logfile, timeout=timeout, cwd=cwd, limits=limits)
+        elif limits is not None:
+            _local_output = io.BytesIO()
+            result = _run_process_logged(arglist, _local_output, timeout=timeout, cwd=cwd, limits=limits)
+            result.stdout = _local_output.getvalue()
+            result.stderr = b''
+        else:
+            result = subprocess.run(
+                    arglist,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    timeout=timeout,
+                    check=False,
+                    cwd=cwd,
+                    );
+            result.max_rss = None
     except subprocess.TimeoutExpired as e:
         # TODO: deal with it
         log.error('subprocess timed out! Exception: {}.'.format(
@@ -174,8 +326,11 @@ def run_process(arglist, timeout=None, check=True) -> subprocess.CompletedProces
         result.check_returncode()
     except subprocess.CalledProcessError as e:
         log.error('subprocess returned with non-zero! Exception: {}.'.format(str(e)))
-        log.error('stderr: {}.'.format(str(result.stderr)))
-        log.error('stdout: {}.'.format(str(result.stdout)))
+        if logfile is None:
+            log.error('stderr: {}.'.format(str(result.stderr)))
+            log.error('stdout: {}.'.format(str(result.stdout)))
+        else:
+            log.error('output: see {}.'.format(getattr(logfile, 'path', logfile)))
         if check == True:
             raise
 
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""debris.control -- local control socket of the debris daemon."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from . import common
+from .common import getconfig
+from .common import log
+
+"requests larger than this are refused."
+MAX_REQUEST_SIZE = 65536
+
+
+class ControlServer(object):
+    """Serve control requests on a unix socket, in a background thread.
+
+    The protocol is one json object per line each way. A request has a
+    `command`; `handler(request)` returns the json-able response. Errors
+    are reported as {"ok": false, "error": "..."}.
+
+    The socket is created with mode 0660, so that the group of the daemon
+    user can use it.
+    """
+
+    def __init__(self, handler, path: str = None):
+        if path is None:
+            path = getconfig('DEBRIS_DAEMON_SOCKET')
+        self.path = path
+        self.handler = handler
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        _local_outer = self
+        class _RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                _local_line = self.rfile.readline(MAX_REQUEST_SIZE)
+                try:
+                    _local_request = json.loads(_local_line.decode())
+                    if not isinstance(_local_request, dict):
+                        raise ValueError('request is not an object')
+                    _local_response = _local_outer.handler(_local_request)
+                except Exception as e:
+                    log.warn('bad control request {!r}: {}'.format(_local_line[:200], str(e)))
+                    _local_response = dict(ok=False, error=str(e))
+                self.wfile.write(json.dumps(_local_response).encode() + b'\n')
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if os.path.exists(self.path):
+            "left over by a daemon that died; we hold the global lock, so it is not in use."
+            os.unlink(self.path)
+        _local_umask = os.umask(0o117)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(self.path, _RequestHandler)
+        finally:
+            os.umask(_local_umask)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+                target=self._server.serve_forever,
+                name='debris-control',
+                daemon=True,
+                )
+        self._thread.start()
+        log.info('listening on control socket {}.'.format(self.path))
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def send_request(request: dict, path: str = None, timeout: float = 30) -> dict:
+    """Send one request to a running daemon and return its response.
+
+    Raise OSError (e.g. FileNotFoundError, ConnectionRefusedError) if no
+    daemon is listening.
+    """
+    if path is None:
+        path = getconfig('DEBRIS_DAEMON_SOCKET')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(json.dumps(request).encode() + b'\n')
+        with s.makefile('rb') as f:
+            return json.loads(f.readline(MAX_REQUEST_SIZE).decode())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""debris.cost -- build cost estimates from the build history."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import statistics
+
+from . import common
+from .common import getconfig
+from .common import log
+
+
+def format_duration(seconds: float) -> str:
+    """Format seconds as e.g. '2h05m', '7m30s' or '12s'."""
+    seconds = int(round(seconds or 0))
+    if seconds >= 3600:
+        return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}s'.format(seconds)
+
+
+class CostModel(object):
+    """Estimated wall-clock seconds of building a package in a chroot.
+
+    Estimates are kept in the db per (package, chroot) as an
+    exponentially weighted mean of the successful build durations, see
+    DebrisDB.update_build_cost(); source-only builds use chroot None.
+
+    Without an estimate for the chroot, the mean estimate of the package
+    in the other chroots is used; for a package never built, the median
+    estimate of all packages, or DEBRIS_SCHEDULER_DEFAULT_COST if
+    nothing was ever built.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.default = getconfig('DEBRIS_SCHEDULER_DEFAULT_COST', float)
+        self._costs = {}
+        "source-only builds are only compared with each other, so these are per (package, binary) and per binary."
+        self._package_costs = {}
+        self._medians = {}
+        for k, v in db.get_build_costs().items():
+            self._set(k[0], k[1], v)
+
+    def _set(self, package: str, chroot: str, cost: float):
+        self._costs[(package, chroot)] = cost
+        self._package_costs.setdefault((package, bool(chroot)), {})[chroot] = cost
+        self._medians.pop(bool(chroot), None)
+
+    def get(self, package: str, chroot: str) -> float:
+        """Return the estimated seconds of building package in chroot."""
+        _local_chroot = chroot or ''
+        if (package, _local_chroot) in self._costs:
+            return self._costs[(package, _local_chroot)]
+        _local_kind = bool(_local_chroot)
+        if (package, _local_kind) in self._package_costs:
+            return statistics.mean(self._package_costs[(package, _local_kind)].values())
+        if _local_kind not in self._medians:
+            _local_same_kind = [v for k, v in self._costs.items() if bool(k[1]) == _local_kind]
+            self._medians[_local_kind] = statistics.median(_local_same_kind) if _local_same_kind else self.default
+        return self._medians[_local_kind]
+
+    def update(self, package: str, chroot: str, duration: float):
+        """Fold the duration of a successful build into the estimates."""
+        if duration is None:
+            return
+        self._set(package, chroot or '', self.db.update_build_cost(package, chroot or '', duration))
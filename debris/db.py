@@ -2,19 +2,113 @@
 #
 # debris.db -- database-related operations for debris
 
+import functools
+import json
+import os
 import sqlite3
+import threading
 import time
 
+from apt import apt_pkg
+
 from . import common
 from .common import run_process
 from .common import getconfig
 from .common import log
 
 
+def _synchronized(func):
+    """Serialize calls that use the shared connection."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def _migrate_initial(c):
+    """The schema as it was before versioning; existing tables are kept."""
+    c.execute('CREATE TABLE IF NOT EXISTS `builtpkg` (`package` TEXT NOT NULL, `version` TEXT NOT NULL);')
+    c.execute('CREATE INDEX IF NOT EXISTS `builtpkg_package_idx` ON `builtpkg` (`package`);')
+    c.execute('CREATE TABLE IF NOT EXISTS `command_history` (`timestamp` INTEGER NOT NULL, `CMDTYPE` TEXT NOT NULL, `OPERATION` TEXT);')
+    c.execute('CREATE TABLE IF NOT EXISTS `build_history` (`timestamp` INTEGER NOT NULL, `package` TEXT NOT NULL, `version` TEXT NOT NULL, `status` INTEGER NOT NULL, `stdout` BLOB, `stderr` BLOB);')
+    _local_columns = [i[1] for i in c.execute('PRAGMA table_info(`build_history`);').fetchall()]
+    for name, sqltype in (('logpath', 'TEXT'), ('logsize', 'INTEGER'), ('excerpt', 'TEXT')):
+        if name not in _local_columns:
+            c.execute('ALTER TABLE `build_history` ADD COLUMN `{}` {};'.format(name, sqltype))
+    c.execute('CREATE TABLE IF NOT EXISTS `submodule_cache` (`path` TEXT PRIMARY KEY, `sha` TEXT NOT NULL, `package` TEXT NOT NULL, `version` TEXT NOT NULL);')
+    c.execute('CREATE TABLE IF NOT EXISTS `chroot_state` (`chroot` TEXT PRIMARY KEY, `release_hash` TEXT, `timestamp` INTEGER NOT NULL);')
+
+def _migrate_build_history_version(c):
+    """Old dbs declared build_history.version as `TEXTNOT NULL`; rebuild it as TEXT NOT NULL."""
+    c.execute('CREATE TABLE `build_history_new` (`timestamp` INTEGER NOT NULL, `package` TEXT NOT NULL, `version` TEXT NOT NULL, `status` INTEGER NOT NULL, `stdout` BLOB, `stderr` BLOB, `logpath` TEXT, `logsize` INTEGER, `excerpt` TEXT);')
+    c.execute("INSERT INTO `build_history_new` SELECT `timestamp`, `package`, COALESCE(`version`, ''), `status`, `stdout`, `stderr`, `logpath`, `logsize`, `excerpt` FROM `build_history` ORDER BY `rowid`;")
+    c.execute('DROP TABLE `build_history`;')
+    c.execute('ALTER TABLE `build_history_new` RENAME TO `build_history`;')
+
+def _migrate_indexes(c):
+    c.execute('DELETE FROM `builtpkg` WHERE `rowid` NOT IN (SELECT MIN(`rowid`) FROM `builtpkg` GROUP BY `package`, `version`);')
+    c.execute('DROP INDEX IF EXISTS `builtpkg_package_idx`;')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS `builtpkg_package_version_idx` ON `builtpkg` (`package`, `version`);')
+    c.execute('CREATE INDEX IF NOT EXISTS `build_history_package_idx` ON `build_history` (`package`, `version`, `timestamp`);')
+    c.execute('CREATE INDEX IF NOT EXISTS `build_history_timestamp_idx` ON `build_history` (`timestamp`);')
+
+def _migrate_incremental_vacuum(c):
+    """Let prune_history() give space back without a full VACUUM."""
+    c.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+    c.execute('VACUUM;')
+
+def _migrate_build_metrics(c):
+    for name, sqltype in (('chroot', 'TEXT'), ('duration', 'REAL'), ('max_rss', 'INTEGER'), ('phases', 'TEXT')):
+        c.execute('ALTER TABLE `build_history` ADD COLUMN `{}` {};'.format(name, sqltype))
+
+def _migrate_build_queue(c):
+    c.execute('CREATE TABLE `build_queue` (`id` INTEGER PRIMARY KEY, `package` TEXT NOT NULL, `force` INTEGER NOT NULL DEFAULT 0, `reason` TEXT, `state` TEXT NOT NULL, `enqueued` INTEGER NOT NULL, `started` INTEGER, `finished` INTEGER);')
+    c.execute('CREATE INDEX `build_queue_state_idx` ON `build_queue` (`state`, `package`);')
+
+def _migrate_chroot_build(c):
+    c.execute('CREATE TABLE `chroot_build` (`package` TEXT NOT NULL, `version` TEXT NOT NULL, `chroot` TEXT NOT NULL, `fingerprint` TEXT NOT NULL, `timestamp` INTEGER NOT NULL, PRIMARY KEY (`package`, `version`, `chroot`, `fingerprint`));')
+
+def _migrate_build_cost(c):
+    """Seed the cost estimates from the successful builds so far, oldest first."""
+    c.execute('CREATE TABLE `build_cost` (`package` TEXT NOT NULL, `chroot` TEXT NOT NULL, `estimate` REAL NOT NULL, `samples` INTEGER NOT NULL, `timestamp` INTEGER NOT NULL, PRIMARY KEY (`package`, `chroot`));')
+    _local_alpha = getconfig('DEBRIS_SCHEDULER_COST_ALPHA', float)
+    _local_costs = {}
+    for package, chroot, duration, timestamp in c.execute('SELECT `package`, COALESCE(`chroot`, \'\'), `duration`, `timestamp` FROM `build_history` WHERE `status` = 1 AND `duration` IS NOT NULL ORDER BY `timestamp`, `rowid`;').fetchall():
+        _local_old = _local_costs.get((package, chroot))
+        if _local_old is None:
+            _local_costs[(package, chroot)] = (duration, 1, timestamp)
+        else:
+            _local_costs[(package, chroot)] = (_local_alpha * duration + (1 - _local_alpha) * _local_old[0], _local_old[1] + 1, timestamp)
+    c.executemany('INSERT INTO `build_cost` (`package`, `chroot`, `estimate`, `samples`, `timestamp`) VALUES (?, ?, ?, ?, ?)', [k + v for k, v in _local_costs.items()])
+
+def _migrate_ccache_stats(c):
+    for name in ('ccache_hits', 'ccache_misses'):
+        c.execute('ALTER TABLE `build_history` ADD COLUMN `{}` INTEGER;'.format(name))
+
+"MIGRATIONS[n] brings a db from PRAGMA user_version n to n + 1; only ever append."
+MIGRATIONS = [
+        _migrate_initial,
+        _migrate_build_history_version,
+        _migrate_indexes,
+        _migrate_incremental_vacuum,
+        _migrate_build_metrics,
+        _migrate_build_queue,
+        _migrate_chroot_build,
+        _migrate_build_cost,
+        _migrate_ccache_stats,
+        ]
+
+
 class DebrisDB(object):
     """Object that can represent the database connection.
 
-    We are using sqlite3 as db.
+    We are using sqlite3 as db, in WAL mode. The schema is versioned
+    with PRAGMA user_version, see MIGRATIONS.
+
+    Build attempts logged with log_transaction() are written in batches;
+    call flush() (or close()) to write them out right away. Reads flush
+    first, so they always see every logged attempt.
     """
 
     conn = None
@@ -29,22 +123,63 @@ class DebrisDB(object):
         else:
             my_dbpath = getconfig('DEBRIS_DB_FILE')
         log.debug('connection sqlite db: {}'.format(my_dbpath))
-        self.conn = sqlite3.connect(my_dbpath)
+        "the connection is shared by threads (e.g. chroot updates), guarded by self._lock."
+        self._lock = threading.RLock()
+        self._pending = []
+        self._pending_since = None
+        self.batch_size = getconfig('DEBRIS_DB_BATCH_SIZE', int)
+        self.batch_interval = getconfig('DEBRIS_DB_BATCH_INTERVAL', int)
+        self.conn = sqlite3.connect(my_dbpath, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL;')
+        self.conn.execute('PRAGMA synchronous = NORMAL;')
         self._sanity_check()
-        # TODO: Complete me
 
     def _sanity_check(self):
         """Run a sanity check.
 
-        If there are any missing tables, create them.
+        Bring the schema up to date by running all pending migrations,
+        each in its own transaction.
         """
         c = self.conn.cursor()
-        c.execute('CREATE TABLE IF NOT EXISTS `builtpkg` (`package` TEXT NOT NULL, `version` TEXT NOT NULL);')
-        c.execute('CREATE TABLE IF NOT EXISTS `command_history` (`timestamp` INTEGER NOT NULL, `CMDTYPE` TEXT NOT NULL, `OPERATION` TEXT);')
-        c.execute('CREATE TABLE IF NOT EXISTS `build_history` (`timestamp` INTEGER NOT NULL, `package` TEXT NOT NULL, `version` TEXTNOT NULL, `status` INTEGER NOT NULL, `stdout` BLOB, `stderr` BLOB);')
-# TODO: recheck this
-        pass
+        _local_version = c.execute('PRAGMA user_version;').fetchone()[0]
+        if _local_version > len(MIGRATIONS):
+            log.error('db schema version {} is newer than this debris ({}).'.format(_local_version, len(MIGRATIONS)))
+            raise Exception('ERR_DB_SCHEMA_TOO_NEW')
+        for i in range(_local_version, len(MIGRATIONS)):
+            log.info('migrating db schema to version {}: {}'.format(i + 1, MIGRATIONS[i].__name__))
+            self.conn.commit()
+            if MIGRATIONS[i] is not _migrate_incremental_vacuum:
+                c.execute('BEGIN;')
+            try:
+                MIGRATIONS[i](c)
+                c.execute('PRAGMA user_version = {};'.format(i + 1))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def _flush(self):
+        """Write pending build attempts in one transaction. Must hold self._lock."""
+        if not self._pending:
+            return
+        log.debug('writing {} build attempt(s) to db...'.format(len(self._pending)))
+        c = self.conn.cursor()
+        c.executemany('INSERT INTO `build_history` (`timestamp`, `package`, `version`, `status`, `stdout`, `stderr`, `logpath`, `logsize`, `excerpt`, `chroot`, `duration`, `max_rss`, `phases`, `ccache_hits`, `ccache_misses`) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self._pending)
+        self.conn.commit()
+        self._pending = []
+        self._pending_since = None
+
+    @_synchronized
+    def flush(self):
+        """Write out all pending build attempts now."""
+        self._flush()
+
+    @_synchronized
+    def close(self):
+        self._flush()
+        self.conn.close()
 
+    @_synchronized
     def get_builtlist(self) -> list:
         """Retrieve a list for previously built packages.
 
@@ -53,12 +188,32 @@ class DebrisDB(object):
              {'package': 'qevercloud', 'version': '3.0.3+ds-1'}]
         """
         builtlist = []
+        self._flush()
         c = self.conn.cursor()
         result = c.execute('SELECT `package`, `version` FROM `builtpkg`;').fetchall()
         for i in result:
             builtlist.append(dict(package=i[0], version=i[1]))
         return builtlist
 
+    @_synchronized
+    def get_builtdict(self) -> dict:
+        """Retrieve the highest built version of each package.
+
+        Debian version ordering cannot be done in SQL, so the maximum is
+        computed here in one pass over the rows.
+
+        :example::
+            {'nixnote2': '2.0~beta9-1', 'qevercloud': '3.0.3+ds-1'}
+        """
+        builtdict = {}
+        self._flush()
+        c = self.conn.cursor()
+        for package, version in c.execute('SELECT DISTINCT `package`, `version` FROM `builtpkg`;'):
+            if package not in builtdict or apt_pkg.version_compare(version, builtdict[package]) > 0:
+                builtdict[package] = version
+        return builtdict
+
+    @_synchronized
     def log_transaction(
             self,
             package: str,
@@ -66,11 +221,299 @@ class DebrisDB(object):
             status: bool,
             stdout: bytes = None,
             stderr: bytes = None,
+            logpath: str = None,
+            logsize: int = None,
+            excerpt: str = None,
+            chroot: str = None,
+            duration: float = None,
+            max_rss: int = None,
+            phases: dict = None,
+            ccache_hits: int = None,
+            ccache_misses: int = None,
             ):
         """Log one building attempt into the database.
+
+        Either give the whole output as stdout/stderr, or, for streamed
+        logs, the path and size of the log file plus a short excerpt.
+
+        `duration` and `phases` ({phase: seconds}) are wall-clock seconds,
+        `max_rss` is the peak RSS of the build in KiB. `ccache_hits` and
+        `ccache_misses` count the compiler cache lookups of the build.
         """
         log.debug('logging build attempt...')
         _current_time = int(time.time())
+        self._pending.append((_current_time, package, version, int(status), stdout, stderr, logpath, logsize, excerpt, chroot, duration, max_rss, json.dumps(phases) if phases is not None else None, ccache_hits, ccache_misses,))
+        if self._pending_since is None:
+            self._pending_since = _current_time
+        if len(self._pending) >= self.batch_size or _current_time - self._pending_since >= self.batch_interval:
+            self._flush()
+
+    @_synchronized
+    def mark_built(self, package: str, version: str):
+        """Record that package/version was built, so get_builtdict() skips it."""
+        log.debug('marking {} {} as built'.format(package, version))
+        c = self.conn.cursor()
+        c.execute('INSERT OR IGNORE INTO `builtpkg` (`package`, `version`) VALUES (?, ?)', (package, version,))
+        self.conn.commit()
+
+    @_synchronized
+    def mark_chroot_built(self, package: str, version: str, chroot: str, fingerprint: str):
+        """Record a successful build of package/version in chroot, from inputs with the given fingerprint."""
+        log.debug('marking {} {} as built in {}, fingerprint {}'.format(package, version, chroot, fingerprint))
+        c = self.conn.cursor()
+        c.execute('INSERT OR REPLACE INTO `chroot_build` (`package`, `version`, `chroot`, `fingerprint`, `timestamp`) VALUES (?, ?, ?, ?, ?)', (package, version, chroot, fingerprint, int(time.time()),))
+        self.conn.commit()
+
+    @_synchronized
+    def get_chroot_builtset(self) -> set:
+        """Retrieve all successful per-chroot builds.
+
+        :example::
+            {('nixnote2', '2.0~beta9-1', 'stretch-amd64-sbuild', '5d41...')}
+        """
+        c = self.conn.cursor()
+        return set(c.execute('SELECT `package`, `version`, `chroot`, `fingerprint` FROM `chroot_build`;').fetchall())
+
+    @_synchronized
+    def get_legacy_builtset(self) -> set:
+        """Retrieve the (package, version) pairs marked built without any per-chroot state.
+
+        These were built before debris recorded builds per chroot.
+        """
+        c = self.conn.cursor()
+        return set(c.execute('SELECT `package`, `version` FROM `builtpkg` WHERE NOT EXISTS (SELECT 1 FROM `chroot_build` WHERE `chroot_build`.`package` = `builtpkg`.`package` AND `chroot_build`.`version` = `builtpkg`.`version`);').fetchall())
+
+    @_synchronized
+    def get_build_history(self, package: str, limit: int = 10) -> list:
+        """Retrieve the latest build attempts of a package, newest first.
+
+        Full output is not loaded; use debris.buildlog.iter_log_lines()
+        on `logpath` to read it lazily.
+        """
+        history = []
+        self._flush()
+        c = self.conn.cursor()
+        result = c.execute('SELECT `rowid`, `timestamp`, `version`, `status`, `logpath`, `logsize`, `excerpt`, `chroot`, `duration`, `max_rss`, `phases`, `ccache_hits`, `ccache_misses` FROM `build_history` WHERE `package` = ? ORDER BY `timestamp` DESC LIMIT ?;', (package, limit,)).fetchall()
+        for i in result:
+            history.append(dict(
+                    id=i[0],
+                    timestamp=i[1],
+                    package=package,
+                    version=i[2],
+                    status=bool(i[3]),
+                    logpath=i[4],
+                    logsize=i[5],
+                    excerpt=i[6],
+                    chroot=i[7],
+                    duration=i[8],
+                    max_rss=i[9],
+                    phases=json.loads(i[10]) if i[10] else None,
+                    ccache_hits=i[11],
+                    ccache_misses=i[12],
+                    ))
+        return history
+
+    @_synchronized
+    def get_build_durations(self, package: str, chroot: str = None, limit: int = 20) -> list:
+        """Retrieve the wall-clock seconds of the latest successful builds of a package, newest first.
+
+        With chroot given, only builds in that chroot count.
+        """
+        self._flush()
+        c = self.conn.cursor()
+        if chroot is None:
+            result = c.execute('SELECT `duration` FROM `build_history` WHERE `package` = ? AND `status` = 1 AND `duration` IS NOT NULL ORDER BY `timestamp` DESC LIMIT ?;', (package, limit,)).fetchall()
+        else:
+            result = c.execute('SELECT `duration` FROM `build_history` WHERE `package` = ? AND `chroot` = ? AND `status` = 1 AND `duration` IS NOT NULL ORDER BY `timestamp` DESC LIMIT ?;', (package, chroot, limit,)).fetchall()
+        return [i[0] for i in result]
+
+    @_synchronized
+    def update_build_cost(self, package: str, chroot: str, duration: float, alpha: float = None) -> float:
+        """Fold the duration of a successful build into the cost estimate of package in chroot.
+
+        The estimate is an exponentially weighted mean, with weight
+        `alpha` (by default DEBRIS_SCHEDULER_COST_ALPHA) for the newest
+        duration. Source-only builds use chroot ''. Return the new
+        estimate in seconds.
+        """
+        if alpha is None:
+            alpha = getconfig('DEBRIS_SCHEDULER_COST_ALPHA', float)
+        c = self.conn.cursor()
+        result = c.execute('SELECT `estimate`, `samples` FROM `build_cost` WHERE `package` = ? AND `chroot` = ?;', (package, chroot,)).fetchone()
+        if result is None:
+            _local_estimate, _local_samples = duration, 1
+        else:
+            _local_estimate, _local_samples = alpha * duration + (1 - alpha) * result[0], result[1] + 1
+        log.debug('cost estimate of {} in {}: {:.1f}s after {} build(s)'.format(package, chroot or 'source', _local_estimate, _local_samples))
+        c.execute('INSERT OR REPLACE INTO `build_cost` (`package`, `chroot`, `estimate`, `samples`, `timestamp`) VALUES (?, ?, ?, ?, ?)', (package, chroot, _local_estimate, _local_samples, int(time.time()),))
+        self.conn.commit()
+        return _local_estimate
+
+    @_synchronized
+    def get_build_costs(self) -> dict:
+        """Retrieve all cost estimates in seconds.
+
+        :example::
+            {('nixnote2', 'stretch-amd64-sbuild'): 1832.5}
+        """
+        c = self.conn.cursor()
+        return dict([((i[0], i[1]), i[2]) for i in c.execute('SELECT `package`, `chroot`, `estimate` FROM `build_cost`;').fetchall()])
+
+    @_synchronized
+    def get_submodule_cache(self) -> dict:
+        """Retrieve the last-seen commit and changelog info of each submodule.
+
+        :example::
+            {'nixnote2': {'sha': '3f2a...', 'package': 'nixnote2', 'version': '2.0~beta9-1'}}
+        """
+        cache = {}
+        c = self.conn.cursor()
+        result = c.execute('SELECT `path`, `sha`, `package`, `version` FROM `submodule_cache`;').fetchall()
+        for i in result:
+            cache[i[0]] = dict(sha=i[1], package=i[2], version=i[3])
+        return cache
+
+    @_synchronized
+    def update_submodule_cache(self, entries: list):
+        """Replace the submodule cache with the given list of dicts.
+
+        Each dict holds `path`, `sha`, `package` and `version`.
+        """
+        log.debug('updating submodule cache, {} entries...'.format(len(entries)))
+        c = self.conn.cursor()
+        c.execute('DELETE FROM `submodule_cache`;')
+        c.executemany('INSERT INTO `submodule_cache` (`path`, `sha`, `package`, `version`) VALUES (?, ?, ?, ?)', [(i['path'], i['sha'], i['package'], i['version'],) for i in entries])
+        self.conn.commit()
+
+    @_synchronized
+    def get_chroot_state(self, chroot: str) -> dict:
+        """Retrieve the archive state a chroot was last upgraded against.
+
+        :example::
+            {'release_hash': '9b1c...', 'timestamp': 1514764800}
+        """
+        c = self.conn.cursor()
+        result = c.execute('SELECT `release_hash`, `timestamp` FROM `chroot_state` WHERE `chroot` = ?;', (chroot,)).fetchone()
+        if result is None:
+            return None
+        return dict(release_hash=result[0], timestamp=result[1])
+
+    @_synchronized
+    def set_chroot_state(self, chroot: str, release_hash: str):
+        """Record that a chroot was just upgraded against release_hash."""
+        log.debug('recording chroot state of {}: {}'.format(chroot, release_hash))
+        c = self.conn.cursor()
+        c.execute('INSERT OR REPLACE INTO `chroot_state` (`chroot`, `release_hash`, `timestamp`) VALUES (?, ?, ?)', (chroot, release_hash, int(time.time()),))
+        self.conn.commit()
+
+    @_synchronized
+    def enqueue(self, package: str, force: bool = False, reason: str = None) -> int:
+        """Put a package into the build queue, return the id of its entry.
+
+        A package is queued at most once; enqueueing it again returns the
+        queued entry, which becomes forced if either request is. A forced
+        entry is built even if its version was built before.
+        """
+        c = self.conn.cursor()
+        result = c.execute('SELECT `id`, `force` FROM `build_queue` WHERE `state` = \'queued\' AND `package` = ?;', (package,)).fetchone()
+        if result is not None:
+            if force and not result[1]:
+                c.execute('UPDATE `build_queue` SET `force` = 1 WHERE `id` = ?;', (result[0],))
+                self.conn.commit()
+            return result[0]
+        log.debug('enqueueing {} ({})'.format(package, reason))
+        c.execute('INSERT INTO `build_queue` (`package`, `force`, `reason`, `state`, `enqueued`) VALUES (?, ?, ?, \'queued\', ?)', (package, int(force), reason, int(time.time()),))
+        self.conn.commit()
+        return c.lastrowid
+
+    @_synchronized
+    def get_queue(self, states: tuple = ('queued', 'running')) -> list:
+        """Retrieve queue entries in the given states, oldest first.
+
+        :example::
+            [{'id': 3, 'package': 'nixnote2', 'force': True, 'reason': 'manual',
+              'state': 'queued', 'enqueued': 1514764800, 'started': None, 'finished': None}]
+        """
+        queue = []
+        c = self.conn.cursor()
+        result = c.execute('SELECT `id`, `package`, `force`, `reason`, `state`, `enqueued`, `started`, `finished` FROM `build_queue` WHERE `state` IN ({}) ORDER BY `id`;'.format(', '.join(['?'] * len(states))), tuple(states)).fetchall()
+        for i in result:
+            queue.append(dict(
+                    id=i[0],
+                    package=i[1],
+                    force=bool(i[2]),
+                    reason=i[3],
+                    state=i[4],
+                    enqueued=i[5],
+                    started=i[6],
+                    finished=i[7],
+                    ))
+        return queue
+
+    @_synchronized
+    def set_queue_state(self, ids: list, state: str):
+        """Move queue entries to 'running', 'done' or 'failed'."""
+        _current_time = int(time.time())
+        c = self.conn.cursor()
+        if state == 'running':
+            c.executemany('UPDATE `build_queue` SET `state` = ?, `started` = ? WHERE `id` = ?;', [(state, _current_time, i,) for i in ids])
+        else:
+            c.executemany('UPDATE `build_queue` SET `state` = ?, `finished` = ? WHERE `id` = ?;', [(state, _current_time, i,) for i in ids])
+        self.conn.commit()
+
+    @_synchronized
+    def requeue_running(self) -> int:
+        """Put entries left 'running' by a previous process back into the queue."""
+        c = self.conn.cursor()
+        c.execute('UPDATE `build_queue` SET `state` = \'queued\', `started` = NULL WHERE `state` = \'running\';')
+        self.conn.commit()
+        if c.rowcount:
+            log.info('requeued {} interrupted build(s).'.format(c.rowcount))
+        return c.rowcount
+
+    @_synchronized
+    def prune_history(self, max_days: int = None, keep: int = None, compact_days: int = None):
+        """Apply the retention policy to build_history.
+
+        Rows older than max_days are deleted, along with their log files,
+        except for the newest `keep` attempts of each package. Rows older
+        than compact_days lose their inline stdout/stderr. Per-chroot
+        build state older than max_days is dropped too, except for the
+        newest build of each package in each chroot, and so are the
+        builtpkg rows of versions left without any. A value of 0
+        disables that part of the policy.
+        """
+        if max_days is None:
+            max_days = getconfig('DEBRIS_DB_HISTORY_DAYS', int)
+        if keep is None:
+            keep = getconfig('DEBRIS_DB_HISTORY_KEEP', int)
+        if compact_days is None:
+            compact_days = getconfig('DEBRIS_DB_COMPACT_DAYS', int)
+        self._flush()
+        _current_time = int(time.time())
         c = self.conn.cursor()
-        c.execute('INSERT INTO `build_history` (`timestamp`, `package`, `version`, `status`, `stdout`, `stderr`) VALUES (?, ?, ?, ?, ?, ?)', (_current_time, package, version, int(status), stdout, stderr,))
+        _local_pruned = []
+        if max_days > 0:
+            _local_where = '`timestamp` < ? AND `rowid` NOT IN (SELECT `rowid` FROM `build_history` AS `h` WHERE `h`.`package` = `build_history`.`package` ORDER BY `h`.`timestamp` DESC LIMIT ?)'
+            _local_args = (_current_time - max_days * 86400, keep,)
+            _local_pruned = [i[0] for i in c.execute('SELECT `logpath` FROM `build_history` WHERE `logpath` IS NOT NULL AND ' + _local_where + ';', _local_args).fetchall()]
+            c.execute('DELETE FROM `build_history` WHERE ' + _local_where + ';', _local_args)
+            log.info('pruned {} old build attempt(s) from db.'.format(c.rowcount))
+        if compact_days > 0:
+            c.execute('UPDATE `build_history` SET `stdout` = NULL, `stderr` = NULL WHERE `timestamp` < ? AND (`stdout` IS NOT NULL OR `stderr` IS NOT NULL);', (_current_time - compact_days * 86400,))
+            log.debug('compacted {} build attempt(s).'.format(c.rowcount))
+        if max_days > 0:
+            "only the newest build of each package in each chroot is still needed."
+            _local_where = '`timestamp` < ? AND `rowid` NOT IN (SELECT `rowid` FROM `chroot_build` AS `b` WHERE `b`.`package` = `chroot_build`.`package` AND `b`.`chroot` = `chroot_build`.`chroot` ORDER BY `b`.`timestamp` DESC LIMIT 1)'
+            _local_versions = c.execute('SELECT DISTINCT `package`, `version` FROM `chroot_build` WHERE ' + _local_where + ';', (_current_time - max_days * 86400,)).fetchall()
+            c.execute('DELETE FROM `chroot_build` WHERE ' + _local_where + ';', (_current_time - max_days * 86400,))
+            "a version without per-chroot state would count as built everywhere, see get_legacy_builtset()."
+            c.executemany('DELETE FROM `builtpkg` WHERE `package` = ? AND `version` = ? AND NOT EXISTS (SELECT 1 FROM `chroot_build` WHERE `chroot_build`.`package` = `builtpkg`.`package` AND `chroot_build`.`version` = `builtpkg`.`version`);', _local_versions)
+            c.execute('DELETE FROM `build_queue` WHERE `state` IN (\'done\', \'failed\') AND `finished` < ?;', (_current_time - max_days * 86400,))
         self.conn.commit()
+        c.execute('PRAGMA incremental_vacuum;').fetchall()
+        for i in _local_pruned:
+            try:
+                os.unlink(i)
+            except OSError:
+                pass
@@ -2,19 +2,27 @@
 
 """debris.git -- git repo integration on building packages for debris."""
 
+import collections
 import os
+import shutil
 import tempfile
+import threading
+import concurrent.futures
 
 import apt
 from apt import apt_pkg
 import git
 import debian
 import debian.changelog
+import debian.deb822
 from debian.changelog import Changelog
+from debian.deb822 import Deb822, PkgRelation
 
 
 from git import Repo
+from git.refs.symbolic import SymbolicReference
 from . import common
+from . import metrics
 from .common import run_process
 from .common import getconfig
 from .common import log, flags
@@ -31,27 +39,88 @@ class DebrisRepo(Repo):
         """Contains information of submodule-like source package.
         """
 
-        repo = None
-        _changelog = None
+        _repo = None
+        path = None
+        sha = None
         package = None
         version = None
-
-        def __init__(self, repo: Repo):
-            self.repo = repo
-            self._changelog = Changelog(
-                    open(
-                        os.path.join(
-                            repo.working_dir, 'debian/changelog'
-                            )
-                        ).read()
-                    )
-            self.package = str(self._changelog.package)
-            self.version = str(self._changelog.get_version())
-
-
-    def __init__(self, *args, **kwargs):
+        binaries = None
+        build_depends = None
+        arch_all_only = None
+
+        def __init__(
+                self,
+                repo: Repo = None,
+                path: str = None,
+                sha: str = None,
+                package: str = None,
+                version: str = None,
+                ):
+            """Init with an opened repo, or with the path of one.
+
+            If package and version are already known (e.g. from the db
+            cache), debian/changelog is not parsed and the repo is only
+            opened when self.repo is first used.
+            """
+            self._repo = repo
+            self.path = path if path else repo.working_dir
+            self.sha = sha
+            if package and version:
+                self.package = package
+                self.version = version
+                return
+            _local_metadata = get_metadata(self.path, sha)
+            self.package = _local_metadata.package
+            self.version = _local_metadata.version
+
+        @property
+        def repo(self) -> Repo:
+            if self._repo is None:
+                self._repo = Repo(self.path)
+            return self._repo
+
+        def load_control(self):
+            """Parse debian/control for binary names and build dependencies.
+
+            Only package names are kept; version constraints, arch
+            qualifiers and alternatives are not resolved here. Also sets
+            arch_all_only if every binary package is Architecture: all.
+            """
+            if self.binaries is not None:
+                return
+            self.binaries = set()
+            self.build_depends = set()
+            self.arch_all_only = False
+            _local_path = os.path.join(self.repo.working_dir, 'debian/control')
+            try:
+                with open(_local_path) as f:
+                    paragraphs = list(Deb822.iter_paragraphs(f))
+            except OSError as e:
+                log.warn('cannot read {}: {}.'.format(_local_path, str(e)))
+                return
+            _local_arches = set()
+            for i in paragraphs:
+                if 'Source' in i:
+                    for field in ('Build-Depends', 'Build-Depends-Indep', 'Build-Depends-Arch'):
+                        if field not in i:
+                            continue
+                        for alternatives in PkgRelation.parse_relations(i[field]):
+                            for j in alternatives:
+                                self.build_depends.add(j['name'])
+                elif 'Package' in i:
+                    self.binaries.add(str(i['Package']))
+                    _local_arches.add(str(i.get('Architecture', '')).strip())
+            self.arch_all_only = _local_arches == {'all'}
+
+
+    pkgcache = None
+
+    def __init__(self, *args, pkgcache=None, **kwargs):
         """Init with the git repo at given path.
 
+        `pkgcache` is an optional DebrisDB used to remember parsed
+        (package, version) of each submodule by its commit sha.
+
         * type I: firstrun
           - git clone.
           - git submodule init (all)
@@ -64,83 +133,133 @@ class DebrisRepo(Repo):
 # TODO: determine if the git repo already exist! FIXME
         super().__init__(*args, **kwargs)
         assert not self.bare
-        self.debris_cleanup()
+        self.pkgcache = pkgcache
+        with metrics.phase('cleanup'):
+            self.debris_cleanup()
 
     def debris_cleanup(self):
         """Update Git repo from remote.
 
         The following steps may apply:
 
-          * for all submodules:
-            - If already called init, reset to HEAD.
-            - If not init, don't touch anything.
-          * hard-reset main module to HEAD.
+          * with UPDATE_GIT_REPO:
+            - pull the main module;
+            - fetch all existing submodules, in parallel;
+          * hard-reset main module to HEAD, then check out all submodules
+            (cloning new ones) in one `git submodule update` pass;
+          * with UPDATE_GIT_REPO, point master and pristine-tar of all
+            submodules at the fetched remote branches, in parallel.
         """
-        if 'UPDATE_GIT_REPO' in flags.keys() and flags['UPDATE_GIT_REPO']:
+        _local_update = 'UPDATE_GIT_REPO' in flags.keys() and flags['UPDATE_GIT_REPO']
+        _local_workers = getconfig('DEBRIS_GIT_FETCH_WORKERS', int)
+        if _local_update:
             log.info('pulling git repo from remote...')
             self.git.pull() # XXX: replace with wrapper
-            log.info('updating git repo submodules...')
-            self.submodule_update(
-                    recursive=True,
-                    force_remove=True,
-                    force_reset=True,
-                    keep_going=False,
-                    )
+            log.info('fetching git repo submodules...')
+            self._for_each_submodule(self._fetch_submodule, _local_workers)
         self.git.reset('--hard', 'HEAD') # XXX: replace with wrapper
-        self.git.submodule('update', '--force', '--recursive')
-        if 'UPDATE_GIT_REPO' in flags.keys() and flags['UPDATE_GIT_REPO']:
-            log.info('WORKAROUND: pulling in any pristine-tar branch.')
-            _local_pkglist = self.get_pkglist()
-            for i in _local_pkglist:
-                _local_subrepo = i.repo
-                try:
-                    _local_subrepo.git.fetch('--tags')
-                    _local_subrepo.git.checkout('origin/master', '-b', 'master')
-                    _local_subrepo.git.checkout('-')
-                except:
-                    pass
-                try:
-                    _local_subrepo.git.checkout('origin/pristine-tar', '-b', 'pristine-tar')
-                    _local_subrepo.git.checkout('-')
-                except:
-                    try:
-                        _local_subrepo.git.checkout('upstream/pristine-tar', '-b', 'pristine-tar')
-                        _local_subrepo.git.checkout('-')
-                    except:
-                        log.warn('repo "{}" does not have pristine-tar, ignoring...'.format(i.package))
-                    pass
-        self.git.reset('--hard', 'HEAD')
-        self.git.submodule('update', '--force', '--recursive')
+        log.info('updating git repo submodules...')
+        self.git.submodule('update', '--init', '--force', '--recursive', '--jobs', str(max(1, _local_workers)))
+        if _local_update:
+            self._for_each_submodule(repo_update_branches, _local_workers)
+
+    def _for_each_submodule(self, func, workers: int):
+        """Call func(repo) for every checked out submodule on a thread pool.
+
+        A failure only affects that submodule; it is logged and skipped.
+        """
+        _local_repos = [i.module() for i in self.submodules if i.module_exists()]
+        def _call(repo):
+            try:
+                func(repo)
+            except Exception as e:
+                log.warn('{} failed for {}: {}'.format(func.__name__, repo.working_dir, str(e)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(_call, _local_repos))
+
+    @staticmethod
+    def _fetch_submodule(repo: Repo):
+        repo.git.fetch(
+                '--tags',
+                'origin',
+                '+refs/heads/*:refs/remotes/origin/*',
+                kill_after_timeout=getconfig('DEBRIS_GIT_FETCH_TIMEOUT', int) or None,
+                )
+
+    def get_gitlinks(self) -> dict:
+        """Return {submodule path: commit sha} recorded in HEAD, in one pass."""
+        gitlinks = {}
+        for i in self.git.ls_tree('-r', 'HEAD').splitlines():
+            _local_meta, _local_path = i.split('\t', 1)
+            _local_mode, _local_type, _local_sha = _local_meta.split()
+            if _local_type == 'commit':
+                gitlinks[_local_path] = _local_sha
+        return gitlinks
 
     def get_pkglist(self) -> list:
         """Obtain a list about the information of existing repo.
+
+        With self.pkgcache set, only the changelogs of submodules whose
+        gitlink sha moved since the last run are parsed.
         """
+        if self.pkgcache is None:
+            pkglist = []
+            for i in self.submodules:
+                subrepo = i.module()
+                pkglist.append(self.PkgRepo(subrepo))
+            assert not (pkglist == [])
+            return pkglist
+
         pkglist = []
-        for i in self.submodules:
-            subrepo = i.module()
-            pkglist.append(self.PkgRepo(subrepo))
+        _local_cache = self.pkgcache.get_submodule_cache()
+        _local_gitlinks = self.get_gitlinks()
+        _local_parsed = 0
+        for path, sha in sorted(_local_gitlinks.items()):
+            _local_fullpath = os.path.join(self.working_dir, path)
+            _local_cached = _local_cache.get(path)
+            if _local_cached and _local_cached['sha'] == sha:
+                pkglist.append(self.PkgRepo(
+                        path=_local_fullpath,
+                        sha=sha,
+                        package=_local_cached['package'],
+                        version=_local_cached['version'],
+                        ))
+            else:
+                log.debug('submodule {} moved to {}, parsing changelog.'.format(path, sha))
+                pkglist.append(self.PkgRepo(path=_local_fullpath, sha=sha))
+                _local_parsed += 1
         assert not (pkglist == [])
+        log.info('{} submodule(s), {} changelog(s) parsed.'.format(len(pkglist), _local_parsed))
+        if _local_parsed or len(_local_cache) != len(pkglist):
+            self.pkgcache.update_submodule_cache([
+                    dict(
+                        path=os.path.relpath(i.path, self.working_dir),
+                        sha=i.sha,
+                        package=i.package,
+                        version=i.version,
+                        )
+                    for i in pkglist])
         return pkglist
 
-    def get_todo_pkglist(self, builtlist: list) -> list:
+    def get_todo_pkglist(self, builtdict: dict, pkglist: list = None, needs_build=None) -> list:
         """Deal with external information about built packages.
 
+        `builtdict` maps package to its highest built version, see
+        DebrisDB.get_builtdict(). If `needs_build(pkgrepo)` is given, it
+        decides instead, e.g. debris.buildstate.BuildState.needs_build().
+        `pkglist` defaults to self.get_pkglist().
+
         Return filtered pkglist."""
-        original_pkglist = self.get_pkglist()
+        if pkglist is None:
+            with metrics.phase('get_pkglist'):
+                pkglist = self.get_pkglist()
         filtered_pkglist = []
-        for i in original_pkglist:
-            package_exist = False
-            should_package = False
+        for i in pkglist:
+            if needs_build is not None:
+                should_package = needs_build(i)
+            else:
+                should_package = self.needs_build(i, builtdict)
             repo_package = i.package
-            repo_version = i.version
-            for j in builtlist:
-                if j['package'] == repo_package:
-                    package_exist = True
-                    if apt_pkg.version_compare(repo_version, j['version']) > 0:
-                        "an outdated package exist."
-                        should_package = True
-            if not package_exist:
-                should_package = True
 
             if 'ONLY_BUILD' in flags:
                if repo_package == flags['ONLY_BUILD']:
@@ -152,7 +271,59 @@ class DebrisRepo(Repo):
                 log.info('Needs-Build: {}/{};'.format(i.package, i.version))
                 filtered_pkglist.append(i)
 
-        return filtered_pkglist
+        return self.sort_pkglist_by_dependency(filtered_pkglist)
+
+    @staticmethod
+    def needs_build(pkgrepo, builtdict: dict) -> bool:
+        """True if no build of pkgrepo's version or a newer one is known."""
+        if pkgrepo.package not in builtdict:
+            return True
+        "an outdated package exist."
+        return apt_pkg.version_compare(pkgrepo.version, builtdict[pkgrepo.package]) > 0
+
+    @staticmethod
+    def get_build_dependency_graph(pkglist: list) -> dict:
+        """Map each source package to the ones in pkglist it build-depends on.
+
+        :example::
+            {'nixnote2': {'qevercloud'}, 'qevercloud': set()}
+        """
+        _local_binary_map = {}
+        for i in pkglist:
+            i.load_control()
+            for j in i.binaries:
+                _local_binary_map[j] = i.package
+        graph = {}
+        for i in pkglist:
+            graph[i.package] = set()
+            for j in i.build_depends:
+                if j in _local_binary_map and _local_binary_map[j] != i.package:
+                    graph[i.package].add(_local_binary_map[j])
+        return graph
+
+    @classmethod
+    def sort_pkglist_by_dependency(cls, pkglist: list) -> list:
+        """Return pkglist in topological order of build dependencies.
+
+        The original order is kept where there is no dependency. A
+        dependency cycle is broken at its first package in original order.
+        """
+        graph = cls.get_build_dependency_graph(pkglist)
+        sorted_pkglist = []
+        _local_done = set()
+        _local_remaining = list(pkglist)
+        while _local_remaining:
+            _local_ready = [i for i in _local_remaining if graph[i.package] <= _local_done]
+            if not _local_ready:
+                log.warn('dependency cycle among: {}, building {} first.'.format(
+                        ', '.join([i.package for i in _local_remaining]),
+                        _local_remaining[0].package))
+                _local_ready = _local_remaining[:1]
+            for i in _local_ready:
+                sorted_pkglist.append(i)
+                _local_done.add(i.package)
+            _local_remaining = [i for i in _local_remaining if i.package not in _local_done]
+        return sorted_pkglist
 
 
 class ClonedRepoContext(object):
@@ -173,57 +344,209 @@ class ClonedRepoContext(object):
        |
        --- debris_XXXXXXX
            |
-           --- package_1_gitdir
+           --- package_1
            |   |
-           |   --- debian/
+           |   --- package_1_gitdir
+           |   |   |
+           |   |   --- debian/
+           |   |   |
+           |   |   --- ...
            |   |
-           |   --- ...
+           |   --- (build results of package_1)
            |
-           --- package_2_gitdir
+           --- package_2
            |   |
-           |   --- debian/
+           |   --- package_2_gitdir
            |   |
            |   --- ...
            |
            --- ...
+
+    Every package gets its own parent dir, so that build results of
+    concurrent builds never end up mixed in the same directory.
+
+    How package repos get there is set by DEBRIS_GIT_CLONE_MODE:
+
+      * full: a plain `git clone`, copying all objects;
+      * shared: `git clone --shared`, borrowing objects of the submodule;
+      * reference: `git clone --reference`, same, via the submodule git dir;
+      * worktree: `git worktree add --detach` on the submodule.
+
+    The tmpdir is created under DEBRIS_BUILD_ROOT if set (e.g. a tmpfs).
+
+    With DEBRIS_WORKSPACE_PERSISTENT = "yes", a persistent workspace dir
+    under DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE is used instead.
+    Existing checkouts there are moved to the new commit rather than
+    cloned again, and least recently used ones are evicted on exit once
+    DEBRIS_WORKSPACE_DISK_BUDGET is exceeded.
     """
 
     def __init__(self, orig_repo: DebrisRepo, todo_list: list, blacklisted_packages: list = []):
         self.orig_repo = orig_repo
         self.todo_list = todo_list
         self.cloned_repo_list = []
-        self.tmpdir = tempfile.TemporaryDirectory(prefix='debris_')
-        self.path = self.tmpdir.name
+        self.cloned_repo_dict = {}
+        self.clone_mode = getconfig('DEBRIS_GIT_CLONE_MODE')
+        if self.clone_mode not in ('full', 'shared', 'reference', 'worktree'):
+            raise Exception('ERR_UNKNOWN_DEBRIS_GIT_CLONE_MODE')
+        self._worktree_origins = []
+        self.persistent = getconfig('DEBRIS_WORKSPACE_PERSISTENT') == "yes"
+        self.workers = max(1, getconfig('DEBRIS_WORKSPACE_WORKERS', int))
+        if self.persistent:
+            self.tmpdir = None
+            self.path = os.path.join(getconfig('DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE'), 'workspace')
+            os.makedirs(self.path, exist_ok=True)
+            log.debug('using persistent workspace: {}'.format(self.path))
+        else:
+            self.tmpdir = tempfile.TemporaryDirectory(
+                    prefix='debris_',
+                    dir=getconfig('DEBRIS_BUILD_ROOT') or None,
+                    )
+            self.path = self.tmpdir.name
+            log.debug('generating building tmpdir: {}'.format(self.tmpdir))
         self.blacklisted_packages = blacklisted_packages
         self._old_cwd = os.getcwd()
-        log.debug('generating building tmpdir: {}'.format(self.tmpdir))
 
     def __enter__(self):
         os.chdir(self.path)
-        for i in self.todo_list:
-            "clone all the repos in the list into tmpdir."
-            if i.package in self.blacklisted_packages:
-                continue
-            log.debug('cloning {}...'.format(i.package))
-            cloned_repo = i.repo.clone(os.path.join(self.path, str(i.package)))
+        _local_todo = [i for i in self.todo_list if i.package not in self.blacklisted_packages]
+        with metrics.phase('clone'), concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            _local_cloned = list(executor.map(self._checkout, _local_todo))
+        for i, cloned_repo in zip(_local_todo, _local_cloned):
             self.cloned_repo_list.append(cloned_repo)
+            self.cloned_repo_dict[i.package] = cloned_repo
 
 # XXX: is there guarantee that the cloned one has the absolutely correct checkout?
         return self
 
+    def _checkout(self, pkgrepo) -> Repo:
+        """Get a checkout of one PkgRepo, reusing a persistent one if possible."""
+        _local_path = os.path.join(self.path, str(pkgrepo.package), str(pkgrepo.package))
+        if self.persistent:
+            os.makedirs(os.path.dirname(_local_path), exist_ok=True)
+            os.utime(os.path.dirname(_local_path))
+            if os.path.isdir(_local_path):
+                try:
+                    return self._update_workspace(pkgrepo.repo, _local_path)
+                except (git.exc.GitError, OSError) as e:
+                    log.warn('cannot reuse workspace {}: {}, cloning again.'.format(_local_path, str(e)))
+                    shutil.rmtree(_local_path)
+        log.debug('cloning {} ({})...'.format(pkgrepo.package, self.clone_mode))
+        return self._clone(pkgrepo.repo, _local_path)
+
+    def _update_workspace(self, origin: Repo, path: str) -> Repo:
+        """Move an existing checkout at path to the commit origin is at."""
+        log.debug('updating workspace {}...'.format(path))
+        _local_sha = origin.head.commit.hexsha
+        repo = Repo(path)
+        if self.clone_mode == 'worktree':
+            "refs are shared with origin, nothing to fetch."
+            self._worktree_origins.append(origin)
+        else:
+            repo.git.fetch('--tags', '--force', 'origin', '+refs/heads/*:refs/remotes/origin/*')
+            repo.git.fetch('origin', 'HEAD')
+            for i in ('master', 'pristine-tar'):
+                try:
+                    repo.git.update_ref('refs/heads/{}'.format(i), 'refs/remotes/origin/{}'.format(i))
+                except git.exc.GitCommandError:
+                    pass
+        repo.git.checkout('--force', '--detach', _local_sha)
+        self.reset_repo(repo)
+        return repo
+
+    def _clone(self, origin: Repo, path: str) -> Repo:
+        """Make a checkout of origin at path according to self.clone_mode."""
+        if self.clone_mode == 'worktree':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            origin.git.worktree('add', '--detach', '--force', path, 'HEAD')
+            self._worktree_origins.append(origin)
+            return Repo(path)
+        elif self.clone_mode == 'shared':
+            return origin.clone(path, shared=True)
+        elif self.clone_mode == 'reference':
+            return origin.clone(path, reference=origin.git_dir)
+        else:
+            return origin.clone(path)
+
     def __exit__(self, type, value, traceback):
-        log.debug('cleaning up tmpdir...')
         os.chdir(self._old_cwd)
-        self.tmpdir.cleanup()
+        if self.persistent:
+            self.evict()
+        else:
+            log.debug('cleaning up tmpdir...')
+            self.tmpdir.cleanup()
+        for i in self._worktree_origins:
+            "forget the worktrees we just removed."
+            i.git.worktree('prune')
+
+    @staticmethod
+    def _get_disk_usage(path: str) -> int:
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for i in files:
+                try:
+                    size += os.lstat(os.path.join(root, i)).st_blocks * 512
+                except OSError:
+                    pass
+        return size
+
+    def evict(self):
+        """Remove least recently used workspaces beyond the disk budget.
+
+        Workspaces used in this run are never evicted.
+        """
+        _local_budget = getconfig('DEBRIS_WORKSPACE_DISK_BUDGET', int)
+        if _local_budget <= 0:
+            return
+        _local_in_use = set([os.path.basename(self.get_build_path(i)) for i in self.cloned_repo_list])
+        _local_workspaces = []
+        for i in os.listdir(self.path):
+            _local_filepath = os.path.join(self.path, i)
+            if os.path.isdir(_local_filepath):
+                _local_workspaces.append((
+                        os.stat(_local_filepath).st_mtime,
+                        i,
+                        self._get_disk_usage(_local_filepath),
+                        ))
+        _local_total = sum([i[2] for i in _local_workspaces])
+        log.debug('workspace uses {} bytes, budget {}.'.format(_local_total, _local_budget))
+        for mtime, name, size in sorted(_local_workspaces):
+            if _local_total <= _local_budget:
+                break
+            if name in _local_in_use:
+                continue
+            log.info('evicting workspace {} ({} bytes).'.format(name, size))
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            _local_total -= size
+
+    @staticmethod
+    def get_build_path(repo: Repo) -> str:
+        """Return the dir where build results of the cloned repo go."""
+        return os.path.dirname(os.path.normpath(repo.working_dir))
+
+    def reset_repo(self, repo: Repo, clean_results: bool = True):
+        """Clean up built files of one cloned repo.
+
+        With clean_results=False, build results next to the repo are kept.
+        """
+        repo.git.reset('--hard')
+        repo.git.clean('-df')
+        repo.git.clean('-Xdf')
+        if not clean_results:
+            return
+        # also remove non-directories in its build path
+        _local_path = self.get_build_path(repo)
+        for i in os.listdir(_local_path):
+            _local_filepath = os.path.join(_local_path, i)
+            if not os.path.isdir(_local_filepath):
+                os.unlink(_local_filepath)
 
     def reset(self):
         """Clean up built files; return to completely clean."""
         # go back to topdir
         os.chdir(self.path)
-        for i in self.cloned_repo_list:
-            i.git.reset('--hard')
-            i.git.clean('-df')
-            i.git.clean('-Xdf')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self.reset_repo, self.cloned_repo_list))
         # also remove non-directories in buildpath
         _local_path = self.path
         for i in os.listdir(_local_path):
@@ -231,55 +554,159 @@ class ClonedRepoContext(object):
             if not os.path.isdir(_local_filepath):
                 os.unlink(_local_filepath)
 
-def repo_is_debian_native(repo: Repo):
-    """Determine if the package is debian native.
+def repo_setup_pristine_tar(repo: Repo) -> bool:
+    """Make sure local master and pristine-tar branches exist.
+
+    Branches are created from remote-tracking ones with `git branch`,
+    without touching the working tree. Return whether pristine-tar
+    is available.
+    """
+    _local_heads = [i.name for i in repo.heads]
+    for branch, candidates in (
+            ('master', ('origin/master',)),
+            ('pristine-tar', ('origin/pristine-tar', 'upstream/pristine-tar')),
+            ):
+        if branch in _local_heads:
+            continue
+        for i in candidates:
+            try:
+                repo.git.branch(branch, i)
+                _local_heads.append(branch)
+                break
+            except git.exc.GitCommandError:
+                pass
+    return 'pristine-tar' in _local_heads
+
+class PkgMetadata(object):
+    """Package metadata of one checkout, from the top debian/changelog entry.
+
+    Only the first changelog block is parsed. Objects are shared through
+    get_metadata(), keyed by the commit sha of the checkout, so the
+    superproject submodule and all its clones parse it once, as long as
+    it stays among the METADATA_CACHE_SIZE most recently used.
     """
 
-    _changelog = Changelog(open(os.path.join(repo.working_dir, 'debian/changelog')).read())
-    _version = _changelog.get_version()
-    if _version._BaseVersion__debian_revision == None: # XXX: using private member
-        return True
-    else:
+    def __init__(self, path: str, sha: str = None):
+        self.sha = sha
+        with open(os.path.join(path, 'debian/changelog')) as f:
+            _local_changelog = Changelog(f, max_blocks=1)
+        _local_version = _local_changelog.get_version()
+        self.package = str(_local_changelog.package)
+        self.version = str(_local_version)
+        self.upstream_version = str(_local_version.upstream_version)
+        self.native = _local_version.debian_revision is None
+        self.upstream_tag = self._get_upstream_tag_version(_local_version, self.native)
+
+    @staticmethod
+    def _get_upstream_tag_version(version, native: bool) -> str:
+        """Get the upstream tag version.
+
+        .. note: this is not a upstream version. Epoch is included here.
+        """
+        log.debug('full version string is: {}'.format(version))
+        _target_str = ""
+        if native:
+            log.debug('this is native debian package.')
+            _target_str = str(version)
+        else:
+            log.debug('this is not native debian package, demangling...')
+            _local_debian_revision = '-' + version.debian_revision
+            log.debug('the debian revision is {}'.format(_local_debian_revision))
+            _target_str = str(version).split(str(_local_debian_revision))[0]
+        log.debug('final unmangled upstream version is: {}'.format(_target_str))
+
+        "Version mangling according to DEP-14."
+        _target_str = _target_str.replace(':', '%').replace('~', '_')
+        while '..' in _target_str:
+            _target_str = _target_str.replace('..', '.#.')
+        if _target_str[-1] == '.':
+            _target_str = _target_str + '#'
+        if _target_str[-5:] == '.lock':
+            _target_str = _target_str[:-5] + '.#lock'
+
+        return _target_str
+
+"most PkgMetadata kept by get_metadata(), least recently used dropped first."
+METADATA_CACHE_SIZE = 1024
+
+"{commit sha: PkgMetadata} in least recently used order, shared by all threads."
+_metadata_cache = collections.OrderedDict()
+_metadata_lock = threading.Lock()
+
+def get_metadata(path: str, sha: str = None) -> PkgMetadata:
+    """Get the metadata of the checkout at path, parsing it only once per commit.
+
+    `sha` is the commit checked out at path; if not given, HEAD is read
+    from the repo without running git.
+    """
+    if sha is None:
+        sha = SymbolicReference.dereference_recursive(Repo(path), 'HEAD')
+    with _metadata_lock:
+        _local_metadata = _metadata_cache.get(sha)
+        if _local_metadata is not None:
+            _metadata_cache.move_to_end(sha)
+    if _local_metadata is None:
+        _local_metadata = PkgMetadata(path, sha)
+        with _metadata_lock:
+            _metadata_cache[sha] = _local_metadata
+            while len(_metadata_cache) > METADATA_CACHE_SIZE:
+                _metadata_cache.popitem(last=False)
+    return _local_metadata
+
+def get_repo_metadata(repo: Repo) -> PkgMetadata:
+    """Get the metadata of the current checkout of repo."""
+    return get_metadata(
+            repo.working_dir,
+            SymbolicReference.dereference_recursive(repo, 'HEAD'),
+            )
+
+def repo_update_branches(repo: Repo) -> bool:
+    """Point local master and pristine-tar at the remote-tracking branches.
+
+    Only refs are moved (`git update-ref`); a branch that is checked out
+    is left alone, as moving it would leave the working tree behind.
+    Return whether pristine-tar is available.
+    """
+    _local_refs = set([i.path for i in repo.refs])
+    _local_current = None if repo.head.is_detached else repo.head.reference.path
+    for branch, candidates in (
+            ('master', ('origin/master',)),
+            ('pristine-tar', ('origin/pristine-tar', 'upstream/pristine-tar')),
+            ):
+        _local_branch = 'refs/heads/' + branch
+        if _local_branch == _local_current:
+            continue
+        for i in candidates:
+            _local_remote = 'refs/remotes/' + i
+            if _local_remote not in _local_refs:
+                continue
+            _local_sha = SymbolicReference.dereference_recursive(repo, _local_remote)
+            if _local_branch not in _local_refs or SymbolicReference.dereference_recursive(repo, _local_branch) != _local_sha:
+                repo.git.update_ref(_local_branch, _local_sha)
+                _local_refs.add(_local_branch)
+            break
+    if 'refs/heads/pristine-tar' not in _local_refs:
+        log.warn('repo "{}" does not have pristine-tar, ignoring...'.format(repo.working_dir))
         return False
+    return True
 
-def _repo_get_changelog(repo: Repo) -> Changelog:
-    return Changelog(open(os.path.join(repo.working_dir, 'debian/changelog')).read())
+def repo_is_debian_native(repo: Repo) -> bool:
+    """Determine if the package is debian native."""
+    return get_repo_metadata(repo).native
 
 def repo_get_package_name(repo: Repo) -> str:
-    _changelog = _repo_get_changelog(repo)
-    return _changelog.package
+    return get_repo_metadata(repo).package
 
 def repo_get_latest_version(repo: Repo) -> str:
-    _changelog = _repo_get_changelog(repo)
-    return str(_changelog.version)
+    return get_repo_metadata(repo).version
+
+def repo_get_upstream_version(repo: Repo) -> str:
+    """Get the upstream version, as used in orig tarball names."""
+    return get_repo_metadata(repo).upstream_version
 
 def repo_get_upstream_tag_version(repo: Repo) -> str:
-    """Get the upstream tag version.
+    """Get the upstream tag version, mangled according to DEP-14.
 
     .. note: this is not a upstream version. Epoch is included here.
     """
-
-    _changelog = _repo_get_changelog(repo)
-    _version = _changelog.get_version()
-    log.debug('full version string is: {}'.format(_version))
-    _target_str = ""
-    if repo_is_debian_native(repo):
-        log.debug('this is native debian package.')
-        _target_str = str(_version)
-    else:
-        log.debug('this is not native debian package, demangling...')
-        _local_debian_revision = '-' + _version._BaseVersion__debian_revision
-        log.debug('the debian revision is {}'.format(_local_debian_revision))
-        _target_str = str(_version).split(str(_local_debian_revision))[0]
-    log.debug('final unmangled upstream version is: {}'.format(_target_str))
-
-    "Version mangling according to DEP-14."
-    _target_str = _target_str.replace(':', '%').replace('~', '_')
-    while '..' in _target_str:
-        _target_str = _target_str.replace('..', '.#.')
-    if _target_str[-1] == '.':
-        _target_str = _target_str + '#'
-    if _target_str[-5:] == '.lock':
-        _target_str = _target_str[:-5] + '.#lock'
-
-    return _target_str
+    return get_repo_metadata(repo).upstream_tag
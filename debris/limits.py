@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""debris.limits -- wall-clock, memory and cpu limits of builds."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import math
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import threading
+import uuid
+
+from . import common
+from .common import getconfig
+from .common import log
+
+"seconds between SIGTERM and SIGKILL when a build is stopped."
+KILL_GRACE = 30
+
+"whether builds can go into their own cgroup; probed once, see cgroup_usable()."
+_cgroup_usable = None
+_cgroup_lock = threading.Lock()
+
+
+def _get_systemd_run() -> list:
+    if os.geteuid() == 0:
+        return ['systemd-run']
+    return ['systemd-run', '--user']
+
+def cgroup_usable() -> bool:
+    """Whether builds can run in their own cgroup v2 scope via systemd-run.
+
+    DEBRIS_BUILD_CGROUP is "yes", "no" or "auto"; with "auto" a trivial
+    scope is started once to find out.
+    """
+    global _cgroup_usable
+    with _cgroup_lock:
+        if _cgroup_usable is not None:
+            return _cgroup_usable
+        _local_setting = getconfig('DEBRIS_BUILD_CGROUP')
+        if _local_setting == 'yes':
+            _cgroup_usable = True
+        elif _local_setting == 'no':
+            _cgroup_usable = False
+        elif _local_setting != 'auto':
+            raise Exception('ERR_UNKNOWN_DEBRIS_BUILD_CGROUP')
+        elif not os.path.exists('/sys/fs/cgroup/cgroup.controllers') or shutil.which('systemd-run') is None:
+            _cgroup_usable = False
+        else:
+            try:
+                _cgroup_usable = subprocess.run(
+                        _get_systemd_run() + ['--scope', '--quiet', '--collect', 'true'],
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        timeout=30,
+                        ).returncode == 0
+            except (OSError, subprocess.SubprocessError):
+                _cgroup_usable = False
+        log.info('builds run in {}.'.format('their own cgroup' if _cgroup_usable else 'process groups with rlimits'))
+        return _cgroup_usable
+
+def get_deadline(durations: list, default: int = None) -> int:
+    """Derive a build deadline in seconds from earlier build durations.
+
+    The deadline is the 95th percentile of `durations` times
+    DEBRIS_BUILD_TIMEOUT_FACTOR, kept within DEBRIS_BUILD_TIMEOUT_MIN
+    and DEBRIS_BUILD_TIMEOUT_MAX. With fewer than
+    DEBRIS_BUILD_TIMEOUT_SAMPLES durations, `default` (by default
+    DEBRIS_BUILD_TIMEOUT) is used. 0 means no deadline.
+    """
+    if default is None:
+        default = getconfig('DEBRIS_BUILD_TIMEOUT', int)
+    _local_durations = sorted([i for i in durations if i is not None])
+    if not _local_durations or len(_local_durations) < getconfig('DEBRIS_BUILD_TIMEOUT_SAMPLES', int):
+        return default
+    _local_p95 = _local_durations[min(len(_local_durations) - 1, math.ceil(0.95 * len(_local_durations)) - 1)]
+    _local_deadline = int(_local_p95 * getconfig('DEBRIS_BUILD_TIMEOUT_FACTOR', float))
+    _local_deadline = max(_local_deadline, getconfig('DEBRIS_BUILD_TIMEOUT_MIN', int))
+    if getconfig('DEBRIS_BUILD_TIMEOUT_MAX', int):
+        _local_deadline = min(_local_deadline, getconfig('DEBRIS_BUILD_TIMEOUT_MAX', int))
+    return _local_deadline
+
+
+class BuildLimits(object):
+    """Limits of one build process tree; pass it to run_process().
+
+    `timeout` is the wall-clock deadline in seconds, `memory` the memory
+    limit in MiB and `cpus` the number of cpus; 0 means no limit.
+
+    The build always runs in its own process group. On expiry the group
+    gets SIGTERM (sbuild then ends its schroot session), and SIGKILL
+    KILL_GRACE seconds later. With a cgroup (see cgroup_usable()), the
+    build runs in a transient systemd scope with MemoryMax and CPUQuota,
+    which covers every process of the build, and the whole scope is
+    killed on expiry. Otherwise RLIMIT_AS and RLIMIT_CPU are set, which
+    only apply per process: by prlimit(1) before the build starts, or,
+    without prlimit, on the build process right after it started.
+    """
+
+    def __init__(self, timeout: int = 0, memory: int = 0, cpus: int = 0):
+        self.timeout = timeout or 0
+        self.memory = memory or 0
+        self.cpus = cpus or 0
+        self.unit = None
+        self.prlimit = False
+
+    def __str__(self):
+        return 'timeout {}s, memory {}MiB, cpus {}'.format(
+                self.timeout or 'unlimited',
+                self.memory or 'unlimited',
+                self.cpus or 'unlimited',
+                )
+
+    @classmethod
+    def for_build(cls, db, package: str, chroot: str, cpus: int = 0, memory: int = 0):
+        """Limits of building package in chroot, with a deadline from its build history.
+
+        Successful builds in the same chroot are preferred; without
+        enough of them, those in any chroot are used. `memory` is the
+        memory reservation of the job, used as the limit if
+        DEBRIS_BUILD_MEMORY_LIMIT is 0.
+        """
+        _local_samples = getconfig('DEBRIS_BUILD_TIMEOUT_SAMPLES', int)
+        _local_durations = db.get_build_durations(package, chroot)
+        if len(_local_durations) < _local_samples:
+            _local_durations = db.get_build_durations(package)
+        return cls(
+                timeout=get_deadline(_local_durations),
+                memory=getconfig('DEBRIS_BUILD_MEMORY_LIMIT', int) or memory,
+                cpus=cpus if getconfig('DEBRIS_BUILD_CPU_LIMIT') == "yes" else 0,
+                )
+
+    def to_dict(self) -> dict:
+        return dict(timeout=self.timeout, memory=self.memory, cpus=self.cpus)
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(
+                timeout=int(d.get('timeout') or 0),
+                memory=int(d.get('memory') or 0),
+                cpus=int(d.get('cpus') or 0),
+                )
+
+    def _get_rlimits(self) -> dict:
+        _local_rlimits = {}
+        if self.memory:
+            _local_bytes = self.memory * 1024 * 1024
+            _local_rlimits[resource.RLIMIT_AS] = (_local_bytes, _local_bytes)
+        if self.timeout and self.cpus:
+            "a runaway process cannot use more cpu time than all its cpus for the whole deadline."
+            _local_seconds = self.timeout * self.cpus
+            _local_rlimits[resource.RLIMIT_CPU] = (_local_seconds, _local_seconds + KILL_GRACE)
+        return _local_rlimits
+
+    def wrap(self, arglist: list) -> list:
+        """Return arglist, run in its own cgroup scope if possible, else under prlimit."""
+        if not (self.memory or self.cpus):
+            return list(arglist)
+        if not cgroup_usable():
+            _local_rlimits = self._get_rlimits()
+            if not _local_rlimits or shutil.which('prlimit') is None:
+                return list(arglist)
+            self.prlimit = True
+            _local_command = ['prlimit']
+            if resource.RLIMIT_AS in _local_rlimits:
+                _local_command.append('--as={}:{}'.format(*_local_rlimits[resource.RLIMIT_AS]))
+            if resource.RLIMIT_CPU in _local_rlimits:
+                _local_command.append('--cpu={}:{}'.format(*_local_rlimits[resource.RLIMIT_CPU]))
+            return _local_command + ['--'] + list(arglist)
+        self.unit = 'debris-build-{}'.format(uuid.uuid4().hex[:12])
+        _local_command = _get_systemd_run() + ['--scope', '--quiet', '--collect', '--unit={}'.format(self.unit)]
+        if self.memory:
+            _local_command += ['-p', 'MemoryMax={}M'.format(self.memory), '-p', 'MemorySwapMax=0']
+        if self.cpus:
+            _local_command += ['-p', 'CPUQuota={}%'.format(self.cpus * 100)]
+        return _local_command + ['--'] + list(arglist)
+
+    def apply(self, p: subprocess.Popen):
+        """Set the rlimits on p if neither a cgroup nor prlimit(1) does; call right after Popen."""
+        if self.unit is not None or self.prlimit:
+            return
+        for k, v in self._get_rlimits().items():
+            try:
+                resource.prlimit(p.pid, k, v)
+            except (OSError, ValueError) as e:
+                log.warn('cannot set rlimit {} of pid {}: {}.'.format(k, p.pid, str(e)))
+
+    def kill(self, p: subprocess.Popen, reaped: threading.Event):
+        """Stop the process tree of p: SIGTERM, then SIGKILL if it is still there."""
+        log.warn('build (pid {}) exceeded its deadline of {}s, stopping it.'.format(p.pid, self.timeout))
+        self._signal(p, signal.SIGTERM)
+        if not reaped.wait(KILL_GRACE):
+            log.warn('build (pid {}) still running, killing it.'.format(p.pid))
+            self._signal(p, signal.SIGKILL)
+
+    def _signal(self, p: subprocess.Popen, signum: int):
+        if self.unit is not None:
+            subprocess.run(
+                    ['systemctl'] + _get_systemd_run()[1:] + ['kill', '--signal={}'.format(signal.Signals(signum).name), '{}.scope'.format(self.unit)],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    )
+        try:
+            os.killpg(p.pid, signum)
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            "e.g. setuid schroot processes; they go away with their session."
+            pass
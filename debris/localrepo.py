@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""debris.localrepo -- local flat apt repositories of freshly built packages."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import gzip
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from debian.deb822 import Deb822, Dsc, Packages, Sources
+from debian.debfile import DebFile
+
+from . import common
+from .common import getconfig
+from .common import log
+
+"dir inside the repo holding the packages, relative to the indexes."
+POOL_DIR = 'pool'
+
+
+def _sha256sum(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _md5sum(path: str) -> str:
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _link_or_copy(src: str, dst: str):
+    """Hardlink src to dst, copying instead across filesystems."""
+    if os.path.exists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def _write_atomic(path: str, data: bytes):
+    with open(path + '.new', 'wb') as f:
+        f.write(data)
+    os.rename(path + '.new', path)
+
+def get_repo_path(suite: str) -> str:
+    """Where the local repo of suite lives on disk."""
+    return os.path.join(getconfig('DEBRIS_LOCALREPO_DIR') or os.path.join(
+            getconfig('DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE'), 'localrepo'), suite)
+
+def get_apt_source(suite: str) -> str:
+    """The sources.list line for the local repo of suite, as seen from the chroot."""
+    if getconfig('DEBRIS_LOCALREPO_URI'):
+        _local_uri = '{}/{}'.format(getconfig('DEBRIS_LOCALREPO_URI').rstrip('/'), suite)
+    else:
+        _local_uri = 'file://{}'.format(get_repo_path(suite))
+    return 'deb [trusted=yes] {} ./'.format(_local_uri)
+
+
+class LocalRepo(object):
+    """The flat apt repository of one suite, fed with the output of finished builds.
+
+    Packages are hardlinked into <path>/pool/. The Packages and Sources
+    indexes are kept in memory, keyed by (package, architecture) and
+    source package; add() replaces the entries of the given files only,
+    then rewrites the indexes and Release, without looking at any other
+    file. A newer build of the same package replaces the older one.
+
+    sbuild gets the repo through get_apt_source() as extra repository
+    in the chroots of that suite only, so the path (or
+    DEBRIS_LOCALREPO_URI) must be reachable from inside the chroots.
+    """
+
+    def __init__(self, suite: str, path: str = None):
+        if path is None:
+            path = get_repo_path(suite)
+        self.suite = suite
+        self.path = path
+        self._lock = threading.Lock()
+        self._packages = {}
+        self._sources = {}
+        os.makedirs(os.path.join(self.path, POOL_DIR), exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Read back the indexes written by earlier runs."""
+        _local_packages = os.path.join(self.path, 'Packages')
+        if os.path.exists(_local_packages):
+            with open(_local_packages) as f:
+                for i in Packages.iter_paragraphs(f):
+                    self._packages[(i['Package'], i['Architecture'])] = i
+        _local_sources = os.path.join(self.path, 'Sources')
+        if os.path.exists(_local_sources):
+            with open(_local_sources) as f:
+                for i in Sources.iter_paragraphs(f):
+                    self._sources[i['Package']] = i
+        log.debug('local repo {}: {} binary, {} source package(s).'.format(
+                self.path,
+                len(self._packages),
+                len(self._sources),
+                ))
+
+    def _pool_add(self, path: str) -> str:
+        _local_name = os.path.join(POOL_DIR, os.path.basename(path))
+        _link_or_copy(path, os.path.join(self.path, _local_name))
+        return _local_name
+
+    def _pool_remove(self, name: str):
+        "the same file may be shared with the replacement, e.g. an orig tarball."
+        _local_used = set([i['Filename'] for i in self._packages.values()])
+        for i in self._sources.values():
+            _local_used.update([os.path.join(POOL_DIR, j['name']) for j in i.get('Files', [])])
+        if name not in _local_used:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def _add_deb(self, path: str):
+        _local_stanza = Packages(DebFile(path).debcontrol())
+        _local_stanza['Filename'] = self._pool_add(path)
+        _local_stanza['Size'] = str(os.path.getsize(path))
+        _local_stanza['MD5sum'] = _md5sum(path)
+        _local_stanza['SHA256'] = _sha256sum(path)
+        _local_key = (_local_stanza['Package'], _local_stanza['Architecture'])
+        _local_old = self._packages.get(_local_key)
+        self._packages[_local_key] = _local_stanza
+        if _local_old and _local_old['Filename'] != _local_stanza['Filename']:
+            self._pool_remove(_local_old['Filename'])
+
+    def _add_dsc(self, path: str):
+        with open(path) as f:
+            _local_dsc = Dsc(f)
+        _local_dir = os.path.dirname(path)
+        for i in _local_dsc.get('Files', []):
+            self._pool_add(os.path.join(_local_dir, i['name']))
+        self._pool_add(path)
+        _local_stanza = Sources()
+        _local_stanza['Package'] = _local_dsc['Source']
+        for k in _local_dsc.keys():
+            if k not in ('Source', 'Files', 'Checksums-Sha1', 'Checksums-Sha256'):
+                _local_stanza[k] = _local_dsc[k]
+        _local_stanza['Directory'] = POOL_DIR
+        _local_stanza['Files'] = [{
+                'md5sum': _md5sum(path),
+                'size': str(os.path.getsize(path)),
+                'name': os.path.basename(path),
+                }] + _local_dsc.get('Files', [])
+        if 'Checksums-Sha256' in _local_dsc:
+            _local_stanza['Checksums-Sha256'] = [{
+                    'sha256': _sha256sum(path),
+                    'size': str(os.path.getsize(path)),
+                    'name': os.path.basename(path),
+                    }] + _local_dsc['Checksums-Sha256']
+        _local_old = self._sources.get(_local_stanza['Package'])
+        self._sources[_local_stanza['Package']] = _local_stanza
+        if _local_old:
+            for i in _local_old.get('Files', []):
+                self._pool_remove(os.path.join(POOL_DIR, i['name']))
+
+    def _write_indexes(self):
+        _local_release = Deb822()
+        _local_release['Origin'] = 'debris'
+        _local_release['Label'] = 'debris local repo'
+        _local_release['Date'] = time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime())
+        _local_release['SHA256'] = ''
+        _local_sums = []
+        for name, stanzas in (('Packages', self._packages), ('Sources', self._sources)):
+            _local_data = '\n'.join([
+                    stanzas[k].dump() for k in sorted(stanzas.keys())
+                    ]).encode()
+            for filename, content in ((name, _local_data), (name + '.gz', gzip.compress(_local_data))):
+                _write_atomic(os.path.join(self.path, filename), content)
+                _local_sums.append(' {} {} {}'.format(
+                        hashlib.sha256(content).hexdigest(),
+                        len(content),
+                        filename,
+                        ))
+        _local_release['SHA256'] = '\n' + '\n'.join(_local_sums)
+        "Release goes last, so it never lists indexes that are not there yet."
+        _write_atomic(os.path.join(self.path, 'Release'), _local_release.dump().encode())
+
+    def add(self, files: list):
+        """Add published .deb/.udeb and .dsc files, ignore everything else."""
+        _local_added = 0
+        with self._lock:
+            for k in files:
+                try:
+                    if k.endswith('.deb') or k.endswith('.udeb'):
+                        self._add_deb(k)
+                    elif k.endswith('.dsc'):
+                        self._add_dsc(k)
+                    else:
+                        continue
+                    _local_added += 1
+                except Exception as e:
+                    log.warn('cannot add {} to local repo: {}.'.format(k, str(e)))
+            if _local_added:
+                self._write_indexes()
+        if _local_added:
+            log.debug('added {} file(s) to local repo {}.'.format(_local_added, self.path))
+
+
+class LocalRepos(object):
+    """The local repos of the given suites.
+
+    Binaries built in a chroot only go into the repo of its suite, so
+    they never satisfy build dependencies of another suite.
+    """
+
+    def __init__(self, suites: list):
+        self.repos = dict([(i, LocalRepo(i)) for i in suites])
+
+    def add(self, files: list, suite: str = None):
+        """Add published files to the repo of suite; without suite, to all of them.
+
+        Source packages are not tied to a suite; binaries always are.
+        """
+        if suite is None:
+            for i in self.repos.values():
+                i.add(files)
+        elif suite in self.repos:
+            self.repos[suite].add(files)
+        else:
+            log.warn('no local repo for suite {}, not adding {} file(s).'.format(suite, len(files)))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""debris.metrics -- phase timings and run metrics for debris."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+from . import common
+from .common import getconfig
+from .common import log
+
+
+class PhaseTimer(object):
+    """Accumulate wall-clock seconds spent in named phases.
+
+    A phase entered several times (e.g. 'reset' for each chroot) adds up.
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._phase_lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._phase_lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time the body of a with-statement as phase `name`."""
+        _local_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - _local_start)
+
+
+class BuildMetrics(PhaseTimer):
+    """Timings of one build job. The scheduler fills in duration.
+
+    For remote builds, remote_duration is the time the worker spent on
+    the build itself, without waiting for a worker or the transfers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.duration = None
+        self.remote_duration = None
+        self.max_rss = None
+        self.ccache = None
+        self.timed_out = False
+
+    def add_rss(self, max_rss: int):
+        """Keep the peak RSS (KiB) of the processes run for this build."""
+        if max_rss is not None and (self.max_rss is None or max_rss > self.max_rss):
+            self.max_rss = max_rss
+
+    def add_ccache(self, stats: dict):
+        """Add up the ccache hits and misses ({'hits': .., 'misses': ..}) of this build."""
+        if stats is None:
+            return
+        if self.ccache is None:
+            self.ccache = dict(hits=0, misses=0)
+        for k in self.ccache:
+            self.ccache[k] += int(stats.get(k) or 0)
+
+
+class RunMetrics(PhaseTimer):
+    """Timings of a whole debris run: its own phases plus every build."""
+
+    def __init__(self):
+        super().__init__()
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.builds = []
+
+    def add_build(self, package: str, version: str, chroot: str, status: str, metrics: BuildMetrics):
+        """Add a finished build; a failed build that ran past its deadline counts as 'timeout'."""
+        if status == 'failed' and metrics.timed_out:
+            status = 'timeout'
+        with self._phase_lock:
+            self.builds.append(dict(
+                    package=package,
+                    version=version,
+                    chroot=chroot or 'source',
+                    status=status,
+                    duration=metrics.duration,
+                    max_rss=metrics.max_rss,
+                    ccache=dict(metrics.ccache) if metrics.ccache is not None else None,
+                    phases=dict(metrics.phases),
+                    ))
+
+    def get_summary(self) -> dict:
+        """A json-friendly summary of the run.
+
+        `build_phases` sums each phase over all builds, which is where to
+        look first for the bottleneck of a run. `ccache` sums the compiler
+        cache hits and misses over all builds.
+        """
+        _local_build_phases = {}
+        for i in self.builds:
+            for k, v in i['phases'].items():
+                _local_build_phases[k] = _local_build_phases.get(k, 0.0) + v
+        _local_status = {}
+        for i in self.builds:
+            _local_status[i['status']] = _local_status.get(i['status'], 0) + 1
+        _local_ccache = dict(hits=0, misses=0)
+        for i in self.builds:
+            for k in _local_ccache:
+                _local_ccache[k] += (i['ccache'] or {}).get(k, 0)
+        return dict(
+                started=self.started,
+                duration=time.monotonic() - self._start,
+                phases=dict(self.phases),
+                build_phases=_local_build_phases,
+                build_status=_local_status,
+                ccache=_local_ccache,
+                builds=sorted(self.builds, key=lambda i: -(i['duration'] or 0)),
+                )
+
+    @staticmethod
+    def _write_atomic(path: str, text: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.rename(path + '.tmp', path)
+
+    def write_summary(self, path: str):
+        """Write the run summary as json."""
+        self._write_atomic(path, json.dumps(self.get_summary(), indent=2, sort_keys=True) + '\n')
+        log.debug('wrote run summary: {}'.format(path))
+
+    def write_textfile(self, path: str):
+        """Write the metrics for the node exporter textfile collector."""
+        _local_summary = self.get_summary()
+        _local_lines = []
+        def _metric(name: str, kind: str, text: str, samples: list):
+            _local_lines.append('# HELP {} {}'.format(name, text))
+            _local_lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                _local_labels = ','.join(['{}="{}"'.format(k, _escape(v)) for k, v in labels])
+                _local_lines.append('{}{} {}'.format(
+                        name,
+                        '{' + _local_labels + '}' if _local_labels else '',
+                        value))
+        _metric('debris_run_start_time_seconds', 'gauge', 'Start time of the last debris run.',
+                [((), _local_summary['started'])])
+        _metric('debris_run_duration_seconds', 'gauge', 'Wall time of the last debris run.',
+                [((), _local_summary['duration'])])
+        _metric('debris_run_phase_seconds', 'gauge', 'Wall time of each run-level phase.',
+                [((('phase', k),), v) for k, v in sorted(_local_summary['phases'].items())])
+        _metric('debris_run_build_phase_seconds', 'gauge', 'Wall time of each build phase, summed over all builds.',
+                [((('phase', k),), v) for k, v in sorted(_local_summary['build_phases'].items())])
+        _metric('debris_run_builds', 'gauge', 'Number of builds by final state.',
+                [((('status', k),), v) for k, v in sorted(_local_summary['build_status'].items())])
+        _local_builds = [i for i in _local_summary['builds'] if i['duration'] is not None]
+        _metric('debris_build_duration_seconds', 'gauge', 'Wall time of each build.',
+                [((('package', i['package']), ('chroot', i['chroot'])), i['duration']) for i in _local_builds])
+        _metric('debris_build_phase_seconds', 'gauge', 'Wall time of each phase of each build.',
+                [((('package', i['package']), ('chroot', i['chroot']), ('phase', k)), v)
+                    for i in _local_builds for k, v in sorted(i['phases'].items())])
+        _metric('debris_build_max_rss_bytes', 'gauge', 'Peak RSS of the largest process of each build.',
+                [((('package', i['package']), ('chroot', i['chroot'])), i['max_rss'] * 1024)
+                    for i in _local_builds if i['max_rss'] is not None])
+        _metric('debris_build_ccache_lookups', 'gauge', 'Compiler cache lookups of each build, by result.',
+                [((('package', i['package']), ('chroot', i['chroot']), ('result', k)), i['ccache'][k])
+                    for i in _local_builds if i['ccache'] is not None for k in ('hits', 'misses')])
+        self._write_atomic(path, '\n'.join(_local_lines) + '\n')
+        log.debug('wrote metrics textfile: {}'.format(path))
+
+    def export(self):
+        """Write the summary and textfile, if configured."""
+        try:
+            if getconfig('DEBRIS_METRICS_SUMMARY'):
+                self.write_summary(getconfig('DEBRIS_METRICS_SUMMARY'))
+            if getconfig('DEBRIS_METRICS_TEXTFILE'):
+                self.write_textfile(getconfig('DEBRIS_METRICS_TEXTFILE'))
+        except OSError as e:
+            log.warn('cannot export metrics: {}.'.format(str(e)))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+"metrics of the current run."
+run = RunMetrics()
+
+def phase(name: str):
+    """Time a run-level phase, e.g. `with metrics.phase('clone'): ...`."""
+    return run.phase(name)
+
+def reset():
+    """Start the metrics of a new run, e.g. for the next daemon cycle."""
+    global run
+    run = RunMetrics()
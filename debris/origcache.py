@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""debris.origcache -- persistent orig tarball cache for debris."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from . import common
+from .common import getconfig
+from .common import log
+
+"name of the checksum file kept next to cached tarballs."
+CHECKSUM_FILE = 'SHA256SUMS'
+
+"serializes stores and evictions between build threads."
+_cache_lock = threading.Lock()
+
+
+def _sha256sum(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _link_or_copy(src: str, dst: str):
+    """Hardlink src to dst, copying instead across filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class OrigCache(object):
+    """Orig tarballs keyed by (source package, upstream version).
+
+    Layout::
+
+        <DEBRIS_ORIGCACHE_DIR>/<source>/<upstream version>/
+            <source>_<upstream version>.orig.tar.xz
+            <source>_<upstream version>.orig-<component>.tar.xz
+            SHA256SUMS
+
+    The cache is shared between chroots and runs. Entries are evicted in
+    least recently used order once DEBRIS_ORIGCACHE_SIZE is exceeded.
+    """
+
+    def __init__(self, path: str = None, size: int = None):
+        if path is None:
+            path = getconfig('DEBRIS_ORIGCACHE_DIR') or os.path.join(
+                    getconfig('DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE'), 'origcache')
+        if size is None:
+            size = getconfig('DEBRIS_ORIGCACHE_SIZE', int)
+        self.path = path
+        self.size = size
+        os.makedirs(self.path, exist_ok=True)
+
+    def _get_entry_path(self, source: str, upstream_version: str) -> str:
+        return os.path.join(self.path, source, upstream_version)
+
+    @staticmethod
+    def _get_pattern(source: str, upstream_version: str) -> str:
+        return '{}_{}.orig*.tar.*'.format(glob.escape(source), glob.escape(upstream_version))
+
+    @staticmethod
+    def _read_sums(entry: str) -> list:
+        """Return the (sha256, size, mtime_ns, name) lines of the SHA256SUMS of entry."""
+        _local_sums = []
+        with open(os.path.join(entry, CHECKSUM_FILE)) as f:
+            for line in f:
+                _local_sum, _local_size, _local_mtime, _local_name = line.split()
+                _local_sums.append((_local_sum, int(_local_size), int(_local_mtime), _local_name))
+        return _local_sums
+
+    def fetch(self, source: str, upstream_version: str, dest: str) -> bool:
+        """Put cached orig tarballs into dest. Return whether there was a hit.
+
+        Cached files are checked by size and mtime only; an entry that
+        does not match is dropped. See verify() for a full check.
+        """
+        _local_entry = self._get_entry_path(source, upstream_version)
+        with _cache_lock:
+            try:
+                _local_sums = self._read_sums(_local_entry)
+            except (OSError, ValueError):
+                log.debug('orig cache miss: {} {}'.format(source, upstream_version))
+                return False
+            for _local_sum, _local_size, _local_mtime, _local_name in _local_sums:
+                try:
+                    _local_stat = os.stat(os.path.join(_local_entry, _local_name))
+                except OSError:
+                    _local_stat = None
+                if _local_stat is None or (_local_stat.st_size, _local_stat.st_mtime_ns) != (_local_size, _local_mtime):
+                    log.warn('orig cache entry {} {} is corrupted, dropping it.'.format(source, upstream_version))
+                    shutil.rmtree(_local_entry, ignore_errors=True)
+                    return False
+            for _local_sum, _local_size, _local_mtime, _local_name in _local_sums:
+                _local_dest = os.path.join(dest, _local_name)
+                if not os.path.exists(_local_dest):
+                    _link_or_copy(os.path.join(_local_entry, _local_name), _local_dest)
+            os.utime(_local_entry)
+        log.info('orig cache hit: {} {}'.format(source, upstream_version))
+        return True
+
+    def store(self, source: str, upstream_version: str, src: str):
+        """Copy freshly generated orig tarballs found in src into the cache."""
+        _local_files = glob.glob(os.path.join(src, self._get_pattern(source, upstream_version)))
+        if not _local_files:
+            log.debug('no orig tarball of {} {} to cache.'.format(source, upstream_version))
+            return
+        _local_entry = self._get_entry_path(source, upstream_version)
+        os.makedirs(os.path.dirname(_local_entry), exist_ok=True)
+        _local_tmp = tempfile.mkdtemp(prefix='.new_', dir=os.path.dirname(_local_entry))
+        with open(os.path.join(_local_tmp, CHECKSUM_FILE), 'w') as f:
+            for i in sorted(_local_files):
+                _local_name = os.path.basename(i)
+                _local_filepath = os.path.join(_local_tmp, _local_name)
+                _link_or_copy(i, _local_filepath)
+                _local_stat = os.stat(_local_filepath)
+                f.write('{} {} {} {}\n'.format(_sha256sum(_local_filepath), _local_stat.st_size, _local_stat.st_mtime_ns, _local_name))
+        with _cache_lock:
+            shutil.rmtree(_local_entry, ignore_errors=True)
+            os.rename(_local_tmp, _local_entry)
+        log.info('cached orig tarball of {} {}.'.format(source, upstream_version))
+        self.evict()
+
+    def verify(self):
+        """Hash every cached tarball and drop the entries that do not match their checksums."""
+        with _cache_lock:
+            for i in glob.glob(os.path.join(self.path, '*', '*')):
+                if os.path.basename(i).startswith('.'):
+                    continue
+                try:
+                    _local_ok = all([_sha256sum(os.path.join(i, j[3])) == j[0] for j in self._read_sums(i)])
+                except (OSError, ValueError):
+                    _local_ok = False
+                if not _local_ok:
+                    log.warn('orig cache entry {} is corrupted, dropping it.'.format(i))
+                    shutil.rmtree(i, ignore_errors=True)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits self.size."""
+        if self.size <= 0:
+            return
+        with _cache_lock:
+            _local_entries = []
+            for i in glob.glob(os.path.join(self.path, '*', '*')):
+                if os.path.basename(i).startswith('.'):
+                    continue
+                _local_size = sum([os.path.getsize(os.path.join(i, j)) for j in os.listdir(i)])
+                _local_entries.append((os.stat(i).st_mtime, i, _local_size))
+            _local_total = sum([i[2] for i in _local_entries])
+            for mtime, path, size in sorted(_local_entries):
+                if _local_total <= self.size:
+                    break
+                log.info('evicting orig cache entry {} ({} bytes).'.format(path, size))
+                shutil.rmtree(path, ignore_errors=True)
+                _local_total -= size
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+"""debris.publish -- move build results into the output dir for debris."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from debian.deb822 import Changes
+
+from . import common
+from .common import getconfig
+from .common import log
+
+"staging dir inside the output dir; same filesystem, so renames are atomic."
+STAGING_DIR = '.incoming'
+
+"conflicting uploads are moved here, inside the output dir."
+QUARANTINE_DIR = '.conflict'
+
+"serializes the final renames of concurrent publishers."
+_publish_lock = threading.Lock()
+
+
+def _sha256sum(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _move(src: str, dst: str):
+    """Rename src to dst, copying instead across filesystems.
+
+    A symlink (e.g. the .build log of sbuild) is replaced by its content.
+    """
+    if not os.path.islink(src):
+        try:
+            os.rename(src, dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    shutil.copy2(src, dst)
+    os.unlink(src)
+
+
+class Upload(object):
+    """A set of files that have to show up in the output dir together.
+
+    An upload is either one .changes file plus every file it lists, or a
+    single file no .changes refers to.
+    """
+
+    def __init__(self, files: list, changes: str = None, checksums: dict = None):
+        self.files = files
+        self.changes = changes
+        self.checksums = checksums or {}
+
+    @classmethod
+    def from_changes(cls, path: str):
+        """Read the file list and checksums of a .changes file."""
+        with open(path) as f:
+            _local_changes = Changes(f)
+        _local_dir = os.path.dirname(path)
+        _local_files = [os.path.join(_local_dir, i['name']) for i in _local_changes.get('Files', [])]
+        _local_checksums = {}
+        for i in _local_changes.get('Checksums-Sha256', []):
+            _local_checksums[i['name']] = i['sha256']
+        return cls(_local_files, path, _local_checksums)
+
+    def __str__(self):
+        return os.path.basename(self.changes or self.files[0])
+
+
+class Publisher(object):
+    """Publish build results into DEBRIS_SBUILD_OUTPUTDIR.
+
+    Files are grouped into uploads by their .changes. Each upload is
+    staged in a hidden dir inside the output dir, then renamed into place
+    with the .changes last, so that tools watching for .changes files never
+    see a partial upload. Files already in the output dir with the same
+    checksum (e.g. source files built in several chroots) are not
+    published again.
+
+    A published file with another checksum is replaced only if no other
+    published .changes lists it; that covers a rebuild of the same
+    version, whose .changes replaces the earlier one as a whole, along
+    with the files only the earlier one listed. Otherwise replacing the
+    file would leave a .changes with a wrong checksum behind, so the
+    upload fails with ERR_PUBLISH_CONFLICT and goes to QUARANTINE_DIR.
+    """
+
+    def __init__(self, outdir: str = None):
+        if outdir is None:
+            outdir = getconfig('DEBRIS_SBUILD_OUTPUTDIR')
+        self.outdir = outdir
+        self.staging = os.path.join(self.outdir, STAGING_DIR)
+        os.makedirs(self.staging, exist_ok=True)
+        os.makedirs(os.path.join(self.outdir, QUARANTINE_DIR), exist_ok=True)
+        "maps a published file to the published .changes listing it; see _get_owners()."
+        self._owners = None
+
+    @staticmethod
+    def get_uploads(path: str) -> list:
+        """Group all files directly in path into uploads."""
+        _local_files = sorted([
+                os.path.join(path, k) for k in os.listdir(path)
+                if not os.path.isdir(os.path.join(path, k))
+                ])
+        _local_uploads = []
+        _local_claimed = set()
+        for k in _local_files:
+            if not k.endswith('.changes'):
+                continue
+            try:
+                _local_upload = Upload.from_changes(k)
+            except Exception as e:
+                log.warn('cannot parse {}: {}, publishing it alone.'.format(k, str(e)))
+                continue
+            _local_missing = [i for i in _local_upload.files if not os.path.exists(i)]
+            if _local_missing:
+                log.warn('{} refers to missing files: {}.'.format(k, ', '.join(_local_missing)))
+            _local_upload.files = [i for i in _local_upload.files if i not in _local_missing]
+            _local_claimed.add(k)
+            _local_claimed.update(_local_upload.files)
+            _local_uploads.append(_local_upload)
+        for k in _local_files:
+            if k not in _local_claimed:
+                _local_uploads.append(Upload([k]))
+        return _local_uploads
+
+    def _get_owners(self) -> dict:
+        """Map each file listed by a published .changes to the set of those .changes.
+
+        The output dir is scanned once; call with _publish_lock held.
+        """
+        if self._owners is None:
+            self._owners = {}
+            for k in os.listdir(self.outdir):
+                if not k.endswith('.changes'):
+                    continue
+                try:
+                    _local_upload = Upload.from_changes(os.path.join(self.outdir, k))
+                except Exception as e:
+                    log.warn('cannot parse published {}: {}.'.format(k, str(e)))
+                    continue
+                for i in _local_upload.files:
+                    self._owners.setdefault(os.path.basename(i), set()).add(k)
+        return self._owners
+
+    def _get_published_sum(self, name: str, size: int) -> str:
+        """The sha256 of the published file name, '' if it is not size bytes, None if there is none."""
+        _local_dest = os.path.join(self.outdir, name)
+        if not os.path.isfile(_local_dest):
+            return None
+        if os.path.getsize(_local_dest) != size:
+            return ''
+        return _sha256sum(_local_dest)
+
+    def _quarantine(self, upload: Upload, files: list) -> str:
+        """Move the files of a conflicting upload out of the way, return where to."""
+        _local_dir = tempfile.mkdtemp(prefix='{}_'.format(upload), dir=os.path.join(self.outdir, QUARANTINE_DIR))
+        for k in files:
+            if os.path.lexists(k):
+                _move(k, os.path.join(_local_dir, os.path.basename(k)))
+        return _local_dir
+
+    def publish_upload(self, upload: Upload) -> list:
+        """Publish one upload atomically, return the paths in the output dir.
+
+        On failure, files not yet renamed into place are moved back; on a
+        conflict, see Publisher, nothing is renamed into place.
+        """
+        _local_tmp = tempfile.mkdtemp(prefix='upload_', dir=self.staging)
+        _local_staged = []
+        _local_sums = {}
+        _local_files = list(upload.files)
+        if upload.changes:
+            _local_files.append(upload.changes)
+        _local_changes = os.path.basename(upload.changes) if upload.changes else None
+        try:
+            for k in _local_files:
+                _local_name = os.path.basename(k)
+                _local_sum = _sha256sum(k)
+                _local_expected = upload.checksums.get(_local_name)
+                if _local_expected and _local_expected != _local_sum:
+                    raise Exception('ERR_CHECKSUM_MISMATCH')
+                _local_sums[_local_name] = (_local_sum, os.path.getsize(k))
+                _move(k, os.path.join(_local_tmp, _local_name))
+                _local_staged.append(k)
+
+            "everything is on the output filesystem now; only renames are left."
+            with _publish_lock:
+                _local_owners = self._get_owners()
+                _local_dropped = set()
+                for k in _local_staged:
+                    _local_name = os.path.basename(k)
+                    if k == upload.changes:
+                        continue
+                    _local_published = self._get_published_sum(_local_name, _local_sums[_local_name][1])
+                    if _local_published == _local_sums[_local_name][0]:
+                        log.debug('{} already published, dropping duplicate.'.format(_local_name))
+                        _local_dropped.add(k)
+                    elif _local_published is not None and _local_owners.get(_local_name, set()) - set([_local_changes]):
+                        log.error('{} is already published with another checksum, listed by {}.'.format(
+                                _local_name, ', '.join(sorted(_local_owners[_local_name]))))
+                        raise Exception('ERR_PUBLISH_CONFLICT')
+                    elif _local_published is not None:
+                        log.info('replacing published {}.'.format(_local_name))
+                while _local_staged:
+                    _local_name = os.path.basename(_local_staged[0])
+                    if _local_staged[0] in _local_dropped:
+                        os.unlink(os.path.join(_local_tmp, _local_name))
+                    else:
+                        os.rename(os.path.join(_local_tmp, _local_name), os.path.join(self.outdir, _local_name))
+                    _local_staged.pop(0)
+                "files only the earlier .changes of the same name listed."
+                _local_stale = []
+                if _local_changes:
+                    _local_names = set([os.path.basename(i) for i in _local_files])
+                    for k, v in _local_owners.items():
+                        if _local_changes in v and k not in _local_names:
+                            v.discard(_local_changes)
+                            if not v:
+                                _local_stale.append(k)
+                for k in _local_stale:
+                    log.info('removing {}, no longer listed by {}.'.format(k, _local_changes))
+                    _local_owners.pop(k, None)
+                    try:
+                        os.unlink(os.path.join(self.outdir, k))
+                    except FileNotFoundError:
+                        pass
+                if _local_changes:
+                    for k in _local_files:
+                        if k != upload.changes:
+                            _local_owners.setdefault(os.path.basename(k), set()).add(_local_changes)
+        except Exception as e:
+            log.error('failed to publish {}: {}.'.format(upload, str(e)))
+            for k in _local_staged:
+                _move(os.path.join(_local_tmp, os.path.basename(k)), k)
+            if str(e) == 'ERR_PUBLISH_CONFLICT':
+                log.error('moved conflicting upload {} to {}.'.format(upload, self._quarantine(upload, _local_files)))
+            raise
+        finally:
+            shutil.rmtree(_local_tmp, ignore_errors=True)
+        _local_published = [os.path.join(self.outdir, os.path.basename(k)) for k in _local_files]
+        log.debug('published {}: {} file(s).'.format(upload, len(_local_published)))
+        return _local_published
+
+    def publish(self, path: str) -> tuple:
+        """Publish everything in path.
+
+        A failing upload is left in path, or quarantined on a conflict,
+        and does not stop the others.
+
+        Return (published, failed): the paths in the output dir and the
+        Uploads that failed.
+        """
+        _local_published = []
+        _local_failed = []
+        for k in self.get_uploads(path):
+            try:
+                _local_published += self.publish_upload(k)
+            except Exception:
+                _local_failed.append(k)
+        return _local_published, _local_failed
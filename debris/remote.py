@@ -0,0 +1,578 @@
+#!/usr/bin/env python3
+
+"""debris.remote -- build jobs on remote workers."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+from debian.deb822 import Dsc
+
+from . import common
+from .limits import BuildLimits
+from .common import getconfig
+from .common import log
+
+PROTOCOL_VERSION = 1
+
+"largest payload of one message; files are sent in chunks of this size."
+CHUNK_SIZE = 1024 * 1024
+
+"largest json header of one message."
+MAX_HEADER_SIZE = 65536
+
+"seconds a worker waits for a job before it is told to ask again."
+IDLE_INTERVAL = 30
+
+"seconds between reconnection attempts of a worker."
+RECONNECT_INTERVAL = 10
+
+"how often a job is handed out again after its worker went away."
+MAX_ATTEMPTS = 3
+
+
+class RemoteAuthError(Exception): pass
+
+
+def get_secret(path: str = None) -> bytes:
+    """Read the secret shared by the coordinator and its workers."""
+    if path is None:
+        path = getconfig('DEBRIS_REMOTE_SECRET_FILE')
+    with open(path, 'rb') as f:
+        _local_secret = f.read().strip()
+    if not _local_secret:
+        raise Exception('ERR_EMPTY_DEBRIS_REMOTE_SECRET')
+    return _local_secret
+
+def parse_address(address: str) -> tuple:
+    """Turn 'host:port' into (host, port); an empty host means all addresses."""
+    _local_host, _, _local_port = address.rpartition(':')
+    return (_local_host.strip('[]'), int(_local_port))
+
+def _check_name(name: str) -> str:
+    """Refuse file names that would end up outside the target dir."""
+    if not isinstance(name, str) or not name or name != os.path.basename(name) or name.startswith('.'):
+        raise RemoteAuthError('bad file name {!r}'.format(name))
+    return name
+
+
+class Channel(object):
+    """A socket carrying authenticated messages.
+
+    A message is a json header line, a line with its MAC, then a binary
+    payload of header['size'] bytes (at most CHUNK_SIZE).
+
+    After handshake(), every message is authenticated with HMAC-SHA256
+    over its sequence number, header and payload, keyed with a session
+    key derived from the shared secret and a random nonce of each side.
+    Messages cannot be forged, altered, replayed or reordered without
+    the secret. They are not encrypted.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self._key = None
+        self._send_seq = 0
+        self._recv_seq = 0
+        self._send_lock = threading.Lock()
+
+    def _mac(self, seq: int, header: bytes, payload: bytes) -> bytes:
+        h = hmac.new(self._key, digestmod=hashlib.sha256)
+        h.update('{}\n'.format(seq).encode())
+        h.update(header + b'\n')
+        h.update(payload)
+        return h.hexdigest().encode()
+
+    def send(self, header: dict, payload: bytes = b''):
+        with self._send_lock:
+            _local_header = json.dumps(dict(header, size=len(payload)), sort_keys=True).encode()
+            _local_mac = self._mac(self._send_seq, _local_header, payload) if self._key else b''
+            self.sock.sendall(_local_header + b'\n' + _local_mac + b'\n' + payload)
+            self._send_seq += 1
+
+    def recv(self) -> tuple:
+        """Return (header, payload) of the next message."""
+        _local_header = self.rfile.readline(MAX_HEADER_SIZE)
+        _local_mac = self.rfile.readline(MAX_HEADER_SIZE)
+        if not _local_header.endswith(b'\n') or not _local_mac.endswith(b'\n'):
+            raise ConnectionError('connection closed')
+        _local_header = _local_header[:-1]
+        header = json.loads(_local_header.decode())
+        if not isinstance(header, dict) or not isinstance(header.get('size'), int) or not 0 <= header['size'] <= CHUNK_SIZE:
+            raise RemoteAuthError('malformed message')
+        payload = self.rfile.read(header['size'])
+        if len(payload) != header['size']:
+            raise ConnectionError('connection closed')
+        if self._key and not hmac.compare_digest(_local_mac[:-1], self._mac(self._recv_seq, _local_header, payload)):
+            raise RemoteAuthError('bad message authentication code')
+        self._recv_seq += 1
+        return header, payload
+
+    def expect(self, kind: str) -> tuple:
+        header, payload = self.recv()
+        if header.get('type') != kind:
+            raise RemoteAuthError('expected {}, got {}'.format(kind, header.get('type')))
+        return header, payload
+
+    def handshake(self, secret: bytes, server: bool):
+        """Agree on a session key; raise RemoteAuthError if the peer does not know the secret."""
+        _local_nonce = os.urandom(32).hex()
+        self.send(dict(type='hello', version=PROTOCOL_VERSION, nonce=_local_nonce))
+        header, _ = self.expect('hello')
+        if header.get('version') != PROTOCOL_VERSION or not isinstance(header.get('nonce'), str):
+            raise RemoteAuthError('unsupported protocol version {}'.format(header.get('version')))
+        if server:
+            _local_nonces = _local_nonce + header['nonce']
+        else:
+            _local_nonces = header['nonce'] + _local_nonce
+        self._key = hmac.new(secret, 'debris-remote {}'.format(_local_nonces).encode(), hashlib.sha256).digest()
+        "the first authenticated message proves that the peer has the same key."
+        self.send(dict(type='auth'))
+        self.expect('auth')
+
+    def send_file(self, path: str, name: str = None):
+        _local_size = os.path.getsize(path)
+        self.send(dict(type='file', name=name or os.path.basename(path), length=_local_size))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                self.send(dict(type='data'), chunk)
+
+    def recv_file(self, header: dict, directory: str) -> str:
+        """Receive the file announced by header into directory, return its path."""
+        _local_path = os.path.join(directory, _check_name(header.get('name')))
+        _local_left = header.get('length')
+        if not isinstance(_local_left, int) or _local_left < 0:
+            raise RemoteAuthError('malformed file header')
+        with open(_local_path, 'wb') as f:
+            while _local_left > 0:
+                _, payload = self.expect('data')
+                if len(payload) > _local_left:
+                    raise RemoteAuthError('file {} longer than announced'.format(header['name']))
+                f.write(payload)
+                _local_left -= len(payload)
+        return _local_path
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RemoteTask(object):
+    """One binary build handed to a worker."""
+
+    def __init__(self, suite: str, arch: str, dsc: str, output_dir: str, jobs: int = 1, logfile=None, limits=None, arch_all: bool = True):
+        self.suite = suite
+        self.arch = arch
+        self.chroot = '{}-{}'.format(suite, arch)
+        self.dsc = dsc
+        self.output_dir = output_dir
+        self.jobs = jobs
+        self.logfile = logfile
+        self.limits = limits
+        self.arch_all = arch_all
+        self.attempts = 0
+        self.worker = None
+        self.result = None
+        self.error = None
+
+    def __str__(self):
+        return '{}@{}'.format(os.path.basename(self.dsc), self.chroot)
+
+
+class RemotePool(object):
+    """Coordinator side: hand binary builds to workers connecting to us.
+
+    Workers connect to DEBRIS_REMOTE_LISTEN, authenticate with the
+    shared secret and tell which suites/arches they have chroots for.
+    Each connection then pulls one build at a time: it gets the .dsc
+    with its files, streams back the build log, uploads the artifacts
+    and finally reports the result. A worker runs several builds by
+    opening several connections.
+
+    build() blocks the calling scheduler thread until a worker finished
+    the build. If a worker goes away mid-build, the build is handed to
+    another one; if no worker for the chroot shows up within
+    DEBRIS_REMOTE_WAIT_TIMEOUT seconds, the build fails.
+    """
+
+    def __init__(self, address: str = None, secret: bytes = None, wait_timeout: int = None):
+        if address is None:
+            address = getconfig('DEBRIS_REMOTE_LISTEN')
+        if secret is None:
+            secret = get_secret()
+        if wait_timeout is None:
+            wait_timeout = getconfig('DEBRIS_REMOTE_WAIT_TIMEOUT', int)
+        self.address = parse_address(address)
+        self.secret = secret
+        self.wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        self._queue = []
+        self._workers = {}
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        _local_outer = self
+        class _RequestHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                _local_outer._serve(self.request, '{}:{}'.format(*self.client_address[:2]))
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer(self.address, _RequestHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+                target=self._server.serve_forever,
+                name='debris-remote',
+                daemon=True,
+                )
+        self._thread.start()
+        log.info('waiting for build workers on {}:{}.'.format(*self._server.server_address[:2]))
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def get_workers(self) -> list:
+        """Describe the connected worker slots.
+
+        :example::
+            [{'name': 'builder2', 'peer': '10.0.0.2:51234',
+              'chroots': ['stretch-amd64'], 'task': 'hello_1.0-1.dsc@stretch-amd64'}]
+        """
+        with self._cond:
+            return [dict(i, chroots=sorted(i['chroots']), task=str(i['task']) if i['task'] else None)
+                    for i in self._workers.values()]
+
+    def _serve(self, sock: socket.socket, peer: str):
+        """Talk to one worker connection until it goes away."""
+        channel = Channel(sock)
+        _local_slot = None
+        try:
+            channel.handshake(self.secret, server=True)
+            header, _ = channel.expect('register')
+            _local_chroots = set(['{}-{}'.format(i['suite'], i['arch']) for i in header.get('chroots', [])])
+            _local_slot = dict(name=str(header.get('worker') or peer), peer=peer, chroots=_local_chroots, task=None)
+            with self._cond:
+                self._workers[id(channel)] = _local_slot
+                self._cond.notify_all()
+            log.info('build worker {} ({}) connected, chroots: {}.'.format(
+                    _local_slot['name'],
+                    peer,
+                    ', '.join(sorted(_local_chroots)),
+                    ))
+            while True:
+                channel.expect('get')
+                task = self._take(_local_slot, IDLE_INTERVAL)
+                if task is None:
+                    channel.send(dict(type='idle'))
+                    continue
+                try:
+                    self._run_task(channel, task)
+                except Exception as e:
+                    self._requeue(task, '{} on {}'.format(str(e), _local_slot['name']))
+                    raise
+        except RemoteAuthError as e:
+            log.warn('rejecting build worker {}: {}.'.format(peer, str(e)))
+        except (OSError, ValueError, KeyError) as e:
+            log.warn('lost build worker {}: {}.'.format(peer, str(e)))
+        finally:
+            channel.close()
+            with self._cond:
+                self._workers.pop(id(channel), None)
+                self._cond.notify_all()
+            if _local_slot is not None:
+                log.info('build worker {} ({}) disconnected.'.format(_local_slot['name'], peer))
+
+    def _take(self, slot: dict, timeout: float) -> RemoteTask:
+        """Pop the oldest queued task slot can build, waiting up to timeout."""
+        _local_deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for task in self._queue:
+                    if task.chroot in slot['chroots']:
+                        self._queue.remove(task)
+                        task.attempts += 1
+                        task.worker = slot['name']
+                        slot['task'] = task
+                        return task
+                _local_left = _local_deadline - time.monotonic()
+                if _local_left <= 0:
+                    return None
+                self._cond.wait(_local_left)
+
+    def _requeue(self, task: RemoteTask, reason: str):
+        with self._cond:
+            for i in self._workers.values():
+                if i['task'] is task:
+                    i['task'] = None
+            if task.attempts >= MAX_ATTEMPTS:
+                task.error = 'gave up after {} attempt(s), last: {}'.format(task.attempts, reason)
+            else:
+                log.warn('build {} interrupted ({}), handing it out again.'.format(task, reason))
+                if task.logfile is not None:
+                    task.logfile.write('\n=== debris: build interrupted ({}), retrying ===\n\n'.format(reason).encode())
+                self._queue.insert(0, task)
+            self._cond.notify_all()
+
+    def _run_task(self, channel: Channel, task: RemoteTask):
+        _local_dir = os.path.dirname(os.path.abspath(task.dsc))
+        with open(task.dsc) as f:
+            _local_files = [task.dsc] + [os.path.join(_local_dir, i['name']) for i in Dsc(f).get('Files', [])]
+        log.info('sending build {} to worker {}.'.format(task, task.worker))
+        channel.send(dict(
+                type='job',
+                suite=task.suite,
+                arch=task.arch,
+                dsc=os.path.basename(task.dsc),
+                jobs=task.jobs,
+                limits=task.limits.to_dict() if task.limits is not None else None,
+                arch_all=task.arch_all,
+                ))
+        for i in _local_files:
+            channel.send_file(i)
+        channel.send(dict(type='end'))
+        os.makedirs(task.output_dir, exist_ok=True)
+        while True:
+            header, payload = channel.recv()
+            if header.get('type') == 'log':
+                if task.logfile is not None:
+                    task.logfile.write(payload)
+            elif header.get('type') == 'file':
+                channel.recv_file(header, task.output_dir)
+            elif header.get('type') == 'result':
+                break
+            else:
+                raise RemoteAuthError('unexpected message {}'.format(header.get('type')))
+        result = subprocess.CompletedProcess(['remote', task.worker, str(task)], int(header['returncode']))
+        result.max_rss = header.get('max_rss')
+        result.worker = task.worker
+        result.ccache = header.get('ccache')
+        result.timed_out = bool(header.get('timed_out'))
+        result.duration = header.get('duration')
+        with self._cond:
+            for i in self._workers.values():
+                if i['task'] is task:
+                    i['task'] = None
+            task.result = result
+            self._cond.notify_all()
+
+    def build(self, suite: str, arch: str, dsc: str, output_dir: str, jobs: int = 1, logfile=None, limits=None, arch_all: bool = True) -> subprocess.CompletedProcess:
+        """Build dsc on some worker with a suite-arch chroot, artifacts go to output_dir.
+
+        `limits` (a debris.limits.BuildLimits) is applied by the worker;
+        the deadline only counts once the worker started the build.
+        arch_all tells whether the build includes arch:all packages, see
+        SBInstance.get_sbuild_options().
+
+        Return the result like run_process() does: `returncode` and
+        `max_rss`, plus the name of the `worker` and, if it uses ccache,
+        the `ccache` stats of the build.
+        """
+        task = RemoteTask(suite, arch, dsc, output_dir, jobs=jobs, logfile=logfile, limits=limits, arch_all=arch_all)
+        _local_since = None
+        with self._cond:
+            self._queue.append(task)
+            self._cond.notify_all()
+            while task.result is None and task.error is None:
+                _local_capable = [i for i in self._workers.values() if task.chroot in i['chroots']]
+                if _local_capable or task not in self._queue:
+                    _local_since = None
+                elif _local_since is None:
+                    _local_since = time.monotonic()
+                elif time.monotonic() - _local_since >= self.wait_timeout:
+                    self._queue.remove(task)
+                    task.error = 'no build worker for {} within {}s'.format(task.chroot, self.wait_timeout)
+                    break
+                self._cond.wait(IDLE_INTERVAL if _local_since is None else max(0.1, min(IDLE_INTERVAL, self.wait_timeout)))
+        if task.error is not None:
+            log.error('remote build {} failed: {}.'.format(task, task.error))
+            raise Exception('ERR_REMOTE_BUILD_FAILED')
+        return task.result
+
+
+class _ChannelLog(object):
+    """File-like object passing build output on to the coordinator."""
+
+    def __init__(self, channel: Channel):
+        self.channel = channel
+        self.path = 'build log on the coordinator'
+
+    def write(self, data: bytes):
+        for i in range(0, len(data), CHUNK_SIZE):
+            self.channel.send(dict(type='log'), data[i:i + CHUNK_SIZE])
+
+
+class RemoteWorker(object):
+    """Worker side: pull builds from the coordinator and run them in local chroots.
+
+    `builder` is the debris.sbuild.SBuilder with the chroots of this
+    host; `slots` builds run at the same time, each over its own
+    connection. Connections are opened again when lost.
+    """
+
+    def __init__(self, builder, address: str = None, secret: bytes = None, name: str = None, slots: int = None):
+        if address is None:
+            address = getconfig('DEBRIS_REMOTE_COORDINATOR')
+        if secret is None:
+            secret = get_secret()
+        if slots is None:
+            slots = getconfig('DEBRIS_REMOTE_WORKER_SLOTS', int)
+        self.builder = builder
+        self.address = parse_address(address)
+        self.secret = secret
+        self.name = name or socket.gethostname()
+        self.slots = max(1, slots)
+        self._stop = threading.Event()
+        self._busy = 0
+        self._busy_cond = threading.Condition()
+
+    def _get_instance(self, suite: str, arch: str):
+        for i in self.builder.instances:
+            if i.suite == suite and i.arch == arch:
+                return i
+        return None
+
+    def _build(self, channel: Channel, header: dict):
+        """Receive one job, build it and send everything back."""
+        _local_dir = tempfile.mkdtemp(prefix='debris_remote_', dir=getconfig('DEBRIS_BUILD_ROOT') or None)
+        try:
+            while True:
+                _local_header, _ = channel.recv()
+                if _local_header.get('type') == 'end':
+                    break
+                if _local_header.get('type') != 'file':
+                    raise RemoteAuthError('unexpected message {}'.format(_local_header.get('type')))
+                channel.recv_file(_local_header, _local_dir)
+            _local_dsc = os.path.join(_local_dir, _check_name(header.get('dsc')))
+            _local_outdir = os.path.join(_local_dir, 'out')
+            os.makedirs(_local_outdir)
+            _local_logfile = _ChannelLog(channel)
+            instance = self._get_instance(header.get('suite'), header.get('arch'))
+            _local_returncode = 1
+            _local_max_rss = None
+            _local_ccache = None
+            _local_timed_out = False
+            _local_duration = None
+            if instance is None:
+                _local_logfile.write('debris: worker {} has no chroot for {}-{}.\n'.format(
+                        self.name, header.get('suite'), header.get('arch')).encode())
+            else:
+                log.info('building {} in {}.'.format(os.path.basename(_local_dsc), instance.chroot))
+                _local_start = time.monotonic()
+                try:
+                    result = instance.buildpkg(
+                            _local_dsc,
+                            buildtype="dsc",
+                            cwd=_local_outdir,
+                            logfile=_local_logfile,
+                            jobs=int(header.get('jobs') or 1),
+                            limits=BuildLimits.from_dict(header['limits']) if header.get('limits') else None,
+                            arch_all=header.get('arch_all', True),
+                            )
+                    _local_returncode = result.returncode
+                    _local_max_rss = result.max_rss
+                    _local_ccache = getattr(result, 'ccache', None)
+                except subprocess.TimeoutExpired as e:
+                    _local_logfile.write('\n=== debris: build timed out after {}s ===\n'.format(e.timeout).encode())
+                    _local_timed_out = True
+                except (OSError, subprocess.SubprocessError) as e:
+                    _local_logfile.write('debris: build failed on worker {}: {}\n'.format(self.name, str(e)).encode())
+                _local_duration = time.monotonic() - _local_start
+            for i in sorted(os.listdir(_local_outdir)):
+                _local_path = os.path.join(_local_outdir, i)
+                if os.path.isfile(_local_path) and not i.startswith('.'):
+                    channel.send_file(_local_path)
+            channel.send(dict(
+                    type='result',
+                    returncode=_local_returncode,
+                    max_rss=_local_max_rss,
+                    ccache=_local_ccache,
+                    timed_out=_local_timed_out,
+                    duration=_local_duration,
+                    ))
+            log.info('finished {}: {}.'.format(os.path.basename(_local_dsc), _local_returncode))
+        finally:
+            shutil.rmtree(_local_dir, ignore_errors=True)
+
+    def _slot(self, number: int):
+        """Keep one connection to the coordinator, building whatever it hands out."""
+        _local_chroots = [dict(suite=i.suite, arch=i.arch) for i in self.builder.instances]
+        while not self._stop.is_set():
+            channel = None
+            try:
+                channel = Channel(socket.create_connection(self.address, timeout=RECONNECT_INTERVAL))
+                channel.sock.settimeout(None)
+                channel.handshake(self.secret, server=False)
+                channel.send(dict(type='register', worker='{}/{}'.format(self.name, number), chroots=_local_chroots))
+                log.info('slot {} connected to coordinator {}:{}.'.format(number, *self.address))
+                while not self._stop.is_set():
+                    channel.send(dict(type='get'))
+                    header, _ = channel.recv()
+                    if header.get('type') == 'idle':
+                        continue
+                    if header.get('type') != 'job':
+                        raise RemoteAuthError('unexpected message {}'.format(header.get('type')))
+                    with self._busy_cond:
+                        self._busy += 1
+                    try:
+                        self._build(channel, header)
+                    finally:
+                        with self._busy_cond:
+                            self._busy -= 1
+                            self._busy_cond.notify_all()
+            except RemoteAuthError as e:
+                log.error('coordinator {}:{} rejected: {}.'.format(self.address[0], self.address[1], str(e)))
+            except (OSError, ValueError) as e:
+                log.warn('slot {}: connection to coordinator lost: {}.'.format(number, str(e)))
+            finally:
+                if channel is not None:
+                    channel.close()
+            self._stop.wait(RECONNECT_INTERVAL)
+
+    def run(self):
+        """Serve until stop() is called; builds in progress are finished first."""
+        log.info('worker {} starting {} slot(s), chroots: {}.'.format(
+                self.name,
+                self.slots,
+                ', '.join([i.chroot for i in self.builder.instances]),
+                ))
+        for i in range(self.slots):
+            threading.Thread(
+                    target=self._slot,
+                    args=(i,),
+                    name='debris-worker-{}'.format(i),
+                    daemon=True,
+                    ).start()
+        self._stop.wait()
+        with self._busy_cond:
+            while self._busy:
+                log.info('waiting for {} build(s) to finish...'.format(self._busy))
+                self._busy_cond.wait()
+
+    def stop(self):
+        self._stop.set()
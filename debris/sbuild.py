@@ -5,13 +5,72 @@
 __license__ = "BSD-3-Clause"
 __docformat__ = "reStructuredText"
 
+from . import ccache
 from . import common
+from . import localrepo
 import configparser
+import concurrent.futures
+import gzip
+import hashlib
+import lzma
+import os
+import subprocess
+import threading
+import time
+import urllib.request
+
+from debian.deb822 import Packages
 
 from .common import run_process
 from .common import getconfig
 from .common import log, flags
 
+def get_privileged_command(arglist: list) -> list:
+    """
+    Prefix arglist with 'sudo -n' unless we are root already.
+    """
+    if os.geteuid() == 0:
+        return list(arglist)
+    return ['sudo', '-n'] + list(arglist)
+
+def get_extra_repo_packages(arch: str) -> dict:
+    """
+    Get the binary packages the extra repository has for arch.
+
+    Return {package: version}, {} if no extra repository is used, or
+    None if its package index cannot be fetched.
+    """
+    if getconfig('DEBRIS_SBUILD_USE_EXTRA_REPO') != "yes":
+        return {}
+    _local_line = getconfig('DEBRIS_SBUILD_EXTRA_REPO')
+    "deb <uri> <suite> [components...]; a suite ending in / is a flat repository."
+    _local_fields = [i for i in _local_line.split() if not i.startswith('[')]
+    if len(_local_fields) < 3:
+        log.warn('cannot parse extra repository {}.'.format(_local_line))
+        return None
+    _local_uri = _local_fields[1].rstrip('/')
+    if _local_fields[2].endswith('/'):
+        _local_dirs = ['{}/{}'.format(_local_uri, _local_fields[2].rstrip('/'))]
+    else:
+        _local_dirs = ['{}/dists/{}/{}/binary-{}'.format(_local_uri, _local_fields[2], i, arch) for i in _local_fields[3:]]
+    _local_packages = {}
+    for i in _local_dirs:
+        for name, decompress in (('Packages.xz', lzma.decompress), ('Packages.gz', gzip.decompress), ('Packages', bytes)):
+            _local_url = '{}/{}'.format(i, name)
+            try:
+                with urllib.request.urlopen(_local_url, timeout=30) as f:
+                    _local_index = decompress(f.read())
+                break
+            except (OSError, ValueError, EOFError, lzma.LZMAError) as e:
+                log.debug('cannot fetch {}: {}'.format(_local_url, str(e)))
+        else:
+            log.warn('cannot get package index of extra repository {} from {}.'.format(_local_line, i))
+            return None
+        for j in Packages.iter_paragraphs(_local_index.decode(errors='replace').splitlines()):
+            if j.get('Architecture') in (arch, 'all') and 'Package' in j:
+                _local_packages[j['Package']] = j['Version']
+    return _local_packages
+
 class SBuilder(object):
     class SBInstance(object):
         """
@@ -20,6 +79,27 @@ class SBuilder(object):
         .. note::
             self.ready is a bool. True or False or None.
 
+            None means we never prepared it in this run; it is used as is.
+            False means prepare() is running, or failed (self.failed).
+            True means prepare() finished successfully.
+
+        With DEBRIS_SBUILD_CHROOT_BACKEND = "overlay", debris manages the
+        chroot itself: a sbuild tarball
+        (DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE/<suite>-<arch>.tar.gz)
+        is unpacked once into a read-only lower dir, and a schroot of
+        type directory with union-type=overlay is registered on top of
+        it. Every build session then gets its own overlay upper dir in
+        DEBRIS_SBUILD_OVERLAY_DIR (meant to be on tmpfs), while
+        concurrent builds share the same base. See setup() and
+        teardown().
+
+        With DEBRIS_CCACHE = "yes", builds use the persistent ccache of
+        the suite/arch in self.ccache, see debris.ccache.CCache.
+
+        Only builds in instances with self.arch_all set include arch:all
+        packages; SBuilder sets it for one instance per suite, so that
+        arch:all files are built, and published, only once.
+
         .. todo::
             use subprocess + communicate() to obtain information.
         """
@@ -39,12 +119,114 @@ class SBuilder(object):
                          getconfig('DEBRIS_SBUILD_CHROOT_SUFFIX', str),
                         ))
             self.ready = None
+            self.failed = False
+            self.arch_all = True
+            self._package_set_hash = None
+            self._package_set_lock = threading.Lock()
+            "cleared while prepare() is pending or running."
+            self._prepared = threading.Event()
+            self._prepared.set()
+            self.ccache = None
+            if getconfig('DEBRIS_CCACHE') == "yes":
+                self.ccache = ccache.CCache(self.suite, self.arch)
+            self.backend = getconfig('DEBRIS_SBUILD_CHROOT_BACKEND')
+            if self.backend == 'overlay':
+                self.chroot = 'debris-{}-{}'.format(self.suite, self.arch)
+            elif self.backend != 'schroot':
+                raise Exception('ERR_UNKNOWN_DEBRIS_SBUILD_CHROOT_BACKEND')
             log.debug('new SBInstance, chroot: {}, arch: {}, suite: {}'.format(
                     self.chroot,
                     self.arch,
                     self.suite,
                     ))
 
+        def _get_overlay_paths(self) -> tuple:
+            """
+            Return (tarball, lower dir, schroot config file) of overlay backend.
+            """
+            _local_base = getconfig('DEBRIS_SBUILD_CHROOT_TARGET_DIRECTORY_BASE')
+            _local_name = '{}-{}'.format(self.suite, self.arch)
+            return (
+                    os.path.join(_local_base, '{}.tar.gz'.format(_local_name)),
+                    os.path.join(_local_base, 'overlay', _local_name),
+                    os.path.join(getconfig('DEBRIS_SBUILD_SCHROOT_CONF_DIR'), self.chroot),
+                    )
+
+        def setup(self):
+            """
+            Set up the chroot before use: its ccache, and for the overlay
+            backend the chroot itself.
+
+            The tarball is unpacked again only if it is newer than the
+            lower dir; otherwise setting up only writes the schroot config.
+            """
+            if self.ccache is not None:
+                self.ccache.setup()
+                if self.backend == 'schroot' and not self.ccache.has_mount(self.chroot):
+                    log.error('the fstab of {} does not bind-mount {} at {}, building without ccache.'.format(
+                            self.chroot, self.ccache.base, ccache.CHROOT_MOUNT_BASE))
+                    self.ccache = None
+            if self.backend != 'overlay':
+                return
+            _local_tarball, _local_lower, _local_conf = self._get_overlay_paths()
+            _local_stamp = os.path.join(os.path.dirname(_local_lower), '.{}.stamp'.format(os.path.basename(_local_lower)))
+            if not os.path.isdir(_local_lower) or (
+                    os.path.exists(_local_tarball) and (
+                        not os.path.exists(_local_stamp) or
+                        os.path.getmtime(_local_tarball) > os.path.getmtime(_local_stamp))):
+                if not os.path.exists(_local_tarball):
+                    log.critical('no chroot tarball at {}!'.format(_local_tarball))
+                    raise Exception('ERR_MISSING_CHROOT_TARBALL')
+                log.info('unpacking chroot tarball {}...'.format(_local_tarball))
+                _local_tmp = _local_lower + '.new'
+                run_process(get_privileged_command(['rm', '-rf', _local_tmp]))
+                run_process(get_privileged_command(['mkdir', '-p', _local_tmp]))
+                run_process(get_privileged_command([
+                        'tar', '--numeric-owner', '-xpf', _local_tarball, '-C', _local_tmp,
+                        ]), 3600)
+                run_process(get_privileged_command(['rm', '-rf', _local_lower]))
+                run_process(get_privileged_command(['mv', _local_tmp, _local_lower]))
+                open(_local_stamp, 'w').close()
+
+            _local_overlay_dir = getconfig('DEBRIS_SBUILD_OVERLAY_DIR')
+            run_process(get_privileged_command(['mkdir', '-p', _local_overlay_dir]))
+            _local_config = '\n'.join([
+                    '[{}]'.format(self.chroot),
+                    'description=debris overlay chroot {}/{}'.format(self.suite, self.arch),
+                    'type=directory',
+                    'directory={}'.format(_local_lower),
+                    'union-type=overlay',
+                    'union-overlay-directory={}'.format(_local_overlay_dir),
+                    'groups=sbuild',
+                    'root-groups=sbuild',
+                    'source-root-groups=sbuild',
+                    'profile=sbuild',
+                    '',
+                    ])
+            if self.ccache is not None:
+                _local_fstab = self.ccache.write_fstab()
+                if _local_fstab is not None:
+                    _local_config += 'setup.fstab={}\n'.format(_local_fstab)
+                else:
+                    self.ccache = None
+            log.debug('writing schroot config: {}'.format(_local_conf))
+            subprocess.run(
+                    get_privileged_command(['tee', _local_conf]),
+                    input=_local_config.encode(),
+                    stdout=subprocess.DEVNULL,
+                    check=True,
+                    )
+
+        def teardown(self):
+            """
+            Unregister the chroot set up by setup(). The lower dir is kept.
+            """
+            if self.backend != 'overlay':
+                return
+            _local_conf = self._get_overlay_paths()[2]
+            log.debug('removing schroot config: {}'.format(_local_conf))
+            run_process(get_privileged_command(['rm', '-f', _local_conf]), check=False)
+
         def _update(self):
             """
             Update the instance by calling 'sbuild-update'.
@@ -59,7 +241,10 @@ class SBuilder(object):
             log.debug('running sbuild-update (update), chroot: {}'.format(
                     self.chroot,
                     ))
-            result = run_process(['sbuild-update', self.chroot], 1800)
+            if getconfig('DEBRIS_SBUILD_APT_PROXY'):
+                result = run_process(self._get_apt_command('update'), 1800)
+            else:
+                result = run_process(['sbuild-update', self.chroot], 1800)
             log.debug('finished sbuild-update (update), chroot: {}'.format(
                     self.chroot,
                     ))
@@ -85,31 +270,255 @@ class SBuilder(object):
             log.debug('running sbuild-update (dist-upgrade), chroot: {}'.format(
                     self.chroot,
                     ))
-            result = run_process(['sbuild-update', '--dist-upgrade', self.chroot], 3600)
+            if getconfig('DEBRIS_SBUILD_APT_PROXY'):
+                result = run_process(self._get_apt_command('dist-upgrade'), 3600)
+            else:
+                result = run_process(['sbuild-update', '--dist-upgrade', self.chroot], 3600)
             log.debug('finished sbuild-update (dist-upgrade), chroot: {}'.format(
                     self.chroot,
                     ))
             pass
 
+        def _get_apt_command(self, action: str) -> list:
+            """
+            Form the apt-get command sbuild-update would run, with a proxy.
+
+            sbuild-update cannot pass options to apt, so when
+            DEBRIS_SBUILD_APT_PROXY is set we call apt-get in the source
+            chroot ourselves. All chroots then download through the same
+            caching proxy (e.g. apt-cacher-ng), so each .deb is only
+            fetched from the mirror once.
+            """
+            return [
+                    'schroot',
+                    '--chroot=source:{}'.format(self.chroot),
+                    '--user=root',
+                    '--directory=/',
+                    '--',
+                    'env',
+                    'DEBIAN_FRONTEND=noninteractive',
+                    'apt-get',
+                    '-y',
+                    '-o', 'Acquire::http::Proxy={}'.format(getconfig('DEBRIS_SBUILD_APT_PROXY')),
+                    '-o', 'Dpkg::Options::=--force-confold',
+                    action,
+                    ]
+
         def _dist_upgrade(self):
             return self._full_upgrade()
 
         def _distupgrade(self):
             return self._full_upgrade()
 
-        def prepare(self):
+        def get_release_hash(self) -> str:
+            """
+            Get the sha256 of InRelease (or Release) of our suite on the mirror.
+
+            DEBRIS_SBUILD_MIRRORURI may also be a file:// URI or a plain
+            path to a local mirror. Return None if it cannot be fetched.
+            """
+            _local_mirror = getconfig('DEBRIS_SBUILD_MIRRORURI').rstrip('/')
+            if _local_mirror.startswith('/'):
+                _local_mirror = 'file://' + _local_mirror
+            for i in ('InRelease', 'Release'):
+                _local_url = '{}/dists/{}/{}'.format(_local_mirror, self.suite, i)
+                try:
+                    with urllib.request.urlopen(_local_url, timeout=30) as f:
+                        return hashlib.sha256(f.read()).hexdigest()
+                except (OSError, ValueError) as e:
+                    log.debug('cannot fetch {}: {}'.format(_local_url, str(e)))
+            log.warn('cannot get release file of {} from {}.'.format(self.suite, _local_mirror))
+            return None
+
+        def get_package_set_hash(self) -> str:
+            """
+            Get the sha256 of the toolchain packages (name, version) in the chroot.
+
+            The toolchain is every Essential package, build-essential,
+            and what they depend on; other packages of the chroot are
+            left out, so that unrelated upgrades do not change the hash.
+
+            If prepare() is pending or running, wait for it first, so the
+            hash is that of the upgraded chroot. The result, also a
+            failure, is kept until the next prepare(). Return None if the
+            chroot cannot be queried.
+            """
+            self._prepared.wait()
+            with self._package_set_lock:
+                if self._package_set_hash is None:
+                    self._package_set_hash = self._query_package_set_hash()
+                return self._package_set_hash or None
+
+        def _query_package_set_hash(self) -> str:
+            """Query the package set hash of the chroot; '' if that fails."""
+            _local_format = '-f=${Package}\t${Version}\t${Essential}\t${Pre-Depends}, ${Depends}\n'
+            if self.backend == 'overlay':
+                _local_command = [
+                        'dpkg-query',
+                        '--admindir={}'.format(os.path.join(self._get_overlay_paths()[1], 'var/lib/dpkg')),
+                        '-W', _local_format,
+                        ]
+            else:
+                _local_command = [
+                        'schroot',
+                        '--chroot={}'.format(self.chroot),
+                        '--directory=/',
+                        '--',
+                        'dpkg-query', '-W', _local_format,
+                        ]
+            try:
+                result = run_process(_local_command, 300)
+            except Exception as e:
+                log.warn('cannot list packages of chroot {}: {}.'.format(self.chroot, str(e)))
+                return ''
+            _local_versions = {}
+            _local_depends = {}
+            _local_todo = ['build-essential']
+            for i in result.stdout.decode(errors='replace').splitlines():
+                _local_fields = (i.split('\t') + ['', '', ''])[:4]
+                _local_versions.setdefault(_local_fields[0], set()).add(_local_fields[1])
+                "alternatives and versions do not matter here, only which packages are there."
+                _local_depends.setdefault(_local_fields[0], set()).update([
+                        j.split('(')[0].split(':')[0].strip()
+                        for j in _local_fields[3].replace('|', ',').split(',')
+                        ])
+                if _local_fields[2] == 'yes':
+                    _local_todo.append(_local_fields[0])
+            _local_toolchain = set()
+            while _local_todo:
+                k = _local_todo.pop()
+                if k in _local_toolchain or k not in _local_versions:
+                    continue
+                _local_toolchain.add(k)
+                _local_todo.extend(_local_depends[k])
+            _local_lines = sorted(['{} {}'.format(k, v) for k in _local_toolchain for v in _local_versions[k]])
+            _local_hash = hashlib.sha256('\n'.join(_local_lines).encode()).hexdigest()
+            log.debug('toolchain of chroot {}: {} package(s), {}'.format(
+                    self.chroot,
+                    len(_local_lines),
+                    _local_hash,
+                    ))
+            return _local_hash
+
+        def needs_upgrade(self, db, release_hash: str) -> bool:
+            """
+            Decide from the recorded chroot state whether to upgrade.
+
+            Skip if the mirror has not changed since the last upgrade, or
+            if the last upgrade is younger than
+            DEBRIS_SBUILD_UPGRADE_MIN_INTERVAL hours.
+            """
+            _local_state = db.get_chroot_state(self.chroot)
+            if _local_state is None or release_hash is None:
+                return True
+            if _local_state['release_hash'] == release_hash:
+                log.info('mirror unchanged for chroot {}.'.format(self.chroot))
+                return False
+            _local_interval = getconfig('DEBRIS_SBUILD_UPGRADE_MIN_INTERVAL', int) * 3600
+            if time.time() - _local_state['timestamp'] < _local_interval:
+                log.info('chroot {} was upgraded less than {}s ago.'.format(self.chroot, _local_interval))
+                return False
+            return True
+
+        def prepare(self, db=None, force: bool = False):
             """
             Prepare the instance to enter ready state.
+
+            With a DebrisDB given, the upgrade is skipped when the mirror
+            has not changed (see needs_upgrade()), unless force is set.
+
+            Failures are recorded in self.failed instead of raised, so
+            that other chroots can go on.
             """
-            self._update()
-            self._full_upgrade()
-            pass
+            self.ready = False
+            self.failed = False
+            self._prepared.clear()
+            try:
+                _local_release_hash = None
+                if db is not None:
+                    _local_release_hash = self.get_release_hash()
+                    if not force and not self.needs_upgrade(db, _local_release_hash):
+                        log.info('skipping upgrade of chroot {}.'.format(self.chroot))
+                        self.ready = True
+                        return
+                self._update()
+                self._full_upgrade()
+                with self._package_set_lock:
+                    self._package_set_hash = None
+                if db is not None:
+                    db.set_chroot_state(self.chroot, _local_release_hash)
+                self.ready = True
+                log.info('chroot {} is ready.'.format(self.chroot))
+            except Exception as e:
+                log.error('preparing chroot {} failed: {}.'.format(self.chroot, str(e)))
+                self.failed = True
+            finally:
+                self._prepared.set()
+
+        def get_sbuild_options(self, jobs: int = 1, quote: bool = False, arch_all: bool = None) -> list:
+            """
+            Return the sbuild options used for every build in this instance.
+
+            With quote=True, values are quoted for the shell; that is
+            needed when the options go through gbp's --git-builder.
+            arch_all overrides self.arch_all, e.g. for builds on remote
+            workers.
+            """
+            if arch_all is None:
+                arch_all = self.arch_all
+            _local_options = ['-A' if arch_all else '--no-arch-all', '-v', '-c', self.chroot]
+            if jobs > 1:
+                _local_options.append('-j{}'.format(jobs))
+            if self.ccache is not None:
+                _local_options.append('--add-depends=ccache')
+            "Enabling extra repo, if specified." # TODO: add command line arguments
+            if getconfig('DEBRIS_SBUILD_USE_EXTRA_REPO') == "yes":
+                if quote:
+                    _local_options.append('--extra-repository="{}"'.format(getconfig('DEBRIS_SBUILD_EXTRA_REPO')))
+                else:
+                    _local_options.append('--extra-repository={}'.format(getconfig('DEBRIS_SBUILD_EXTRA_REPO')))
+                _local_options.append('--extra-repository-key={}'.format(getconfig('DEBRIS_SBUILD_EXTRA_REPO_KEY')))
+            "Packages of this suite built earlier in this run, straight from local disk."
+            if getconfig('DEBRIS_LOCALREPO') == "yes":
+                if quote:
+                    _local_options.append('--extra-repository="{}"'.format(localrepo.get_apt_source(self.suite)))
+                else:
+                    _local_options.append('--extra-repository={}'.format(localrepo.get_apt_source(self.suite)))
+            return _local_options
+
+        def buildpkg(
+                self,
+                keyfilepath : str,
+                buildtype: str = "dsc",
+                cwd: str = None,
+                logfile=None,
+                jobs: int = 1,
+                gbp_options: list = None,
+                limits=None,
+                arch_all: bool = None,
+                ):
+            """
+            Build binary packages in this instance.
+
+            * buildtype "dsc": keyfilepath is a .dsc; sbuild puts the
+              results into cwd (default: the dir of the .dsc).
+            * buildtype "path": keyfilepath is a git checkout; gbp builds
+              the source and calls sbuild, results go to its parent dir.
+              gbp_options are extra options for gbp (e.g. pristine-tar).
+
+            `limits` is a debris.limits.BuildLimits for the build; for
+            arch_all, see get_sbuild_options().
 
-        def buildpkg(self, keyfilepath : str, buildtype: str = "dsc"):
+            Return the subprocess.CompletedProcess of the build; a failed
+            build does not raise. With ccache, the result also has
+            `ccache`, the hits and misses of the build, see
+            CCache.finish_build().
+            """
             # prefer using arch + suite rather than hardcoded schroot option
-            log.info('trying to build pkg, path: {}, type: {}.'.format(
+            log.info('trying to build pkg, path: {}, type: {}, chroot: {}.'.format(
                     keyfilepath,
                     buildtype,
+                    self.chroot,
                     ))
             # determine the place to put the packages
             _sbuild_outputdir = getconfig('DEBRIS_SBUILD_OUTPUTDIR')
@@ -117,13 +526,13 @@ class SBuilder(object):
                 log.critical('PACKAGE OUTPUT DIR NOT SET!')
                 raise Exception('ERR_MISSING_DEBRIS_SBUILD_OUTPUTDIR_CONFIG')
             if buildtype == "dsc":
-                if self.arch and self.suite:
-                    run_process([
+                _local_command = [
                         'sbuild',
                         '--dist={}'.format(self.suite),
                         '--arch={}'.format(self.arch),
-                        keyfilepath,
-                        ])
+                        ] + self.get_sbuild_options(jobs, arch_all=arch_all) + [keyfilepath]
+                if cwd is None:
+                    cwd = os.path.dirname(os.path.abspath(keyfilepath))
             elif buildtype == "path":
                 """all we need to do is to:
                  * Enter the path.
@@ -135,11 +544,33 @@ class SBuilder(object):
 
                     We do not need to clean the environment.
                  """
-# TODO: Finish me
-                pass
+                _local_command = [
+                        'gbp',
+                        'buildpackage',
+                        '--git-submodules',
+                        '--git-ignore-branch',
+                        ] + (gbp_options or []) + [
+                        '--git-builder={}'.format(' '.join(
+                            ['sbuild', '--source-only-changes'] + self.get_sbuild_options(jobs, quote=True, arch_all=arch_all))),
+                        ]
+                cwd = keyfilepath
             else:
                 raise NotImplementedError('ERR_BUILDPKG_TYPE_UNKNOWN')
-            pass
+            if self.ccache is None:
+                log.debug('Build command: {}'.format(str(_local_command)))
+                return run_process(_local_command, check=False, cwd=cwd, logfile=logfile, limits=limits)
+            "sbuild, also when run by gbp, picks up the ccache setup from its config."
+            _local_sbuildrc = self.ccache.start_build()
+            _local_command = ['env', 'SBUILD_CONFIG={}'.format(_local_sbuildrc)] + _local_command
+            log.debug('Build command: {}'.format(str(_local_command)))
+            try:
+                result = run_process(_local_command, check=False, cwd=cwd, logfile=logfile, limits=limits)
+            finally:
+                _local_stats = self.ccache.finish_build(_local_sbuildrc)
+            result.ccache = _local_stats
+            if _local_stats is not None:
+                log.info('ccache of {}: {} hit(s), {} miss(es).'.format(self.chroot, _local_stats['hits'], _local_stats['misses']))
+            return result
 
 
     def __init__(self):
@@ -159,6 +590,13 @@ class SBuilder(object):
                         )
         for i in self._chroot_list:
             self.instances.append(self.SBInstance(CHROOT=i))
+        "arch:all packages are built in the first chroot of each suite only."
+        _local_suites = set()
+        for i in self.instances:
+            i.arch_all = i.suite not in _local_suites
+            _local_suites.add(i.suite)
+        self._prepare_executor = None
+        self._prepare_futures = []
 
 #TODO FINISH ME
         pass
@@ -179,16 +617,62 @@ class SBuilder(object):
         The detailed description is from debris.conf.
         """
 
-    def prepare(self):
+    def setup(self):
+        """
+        Set up all instances; see SBInstance.setup().
+        """
+        for i in self.instances:
+            i.setup()
+
+    def teardown(self):
+        """
+        Tear down all instances; see SBInstance.teardown().
+        """
+        for i in self.instances:
+            i.teardown()
+
+    def prepare(self, wait: bool = True, workers: int = None, db=None, force: bool = False):
         """
         Prepare all instances, using sbuild-update.
+
+        `db` and `force` are passed on to SBInstance.prepare().
+
+        Up to `workers` (default DEBRIS_SBUILD_PREPARE_WORKERS) chroots
+        are updated at the same time. With wait=False, return right
+        away; every instance has ready = False until its own update is
+        done, so builds can start chroot by chroot. Call
+        wait_prepared() before exiting.
         """
+        if workers is None:
+            workers = getconfig('DEBRIS_SBUILD_PREPARE_WORKERS', int)
         log.info('starting to update all chroot instances...')
         for i in self.instances:
-            i.prepare()
-        log.info('all chroot instances updated.')
+            i.ready = False
+            i._prepared.clear()
+        self._prepare_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, workers),
+                thread_name_prefix='debris-prepare',
+                )
+        self._prepare_futures = [self._prepare_executor.submit(i.prepare, db, force) for i in self.instances]
+        if wait:
+            self.wait_prepared()
         return
 
+    def wait_prepared(self):
+        """
+        Block until all chroot updates started by prepare() are done.
+        """
+        if self._prepare_executor is None:
+            return
+        concurrent.futures.wait(self._prepare_futures)
+        self._prepare_executor.shutdown()
+        self._prepare_executor = None
+        _local_failed = [i.chroot for i in self.instances if i.failed]
+        if _local_failed:
+            log.error('chroot instances failed to update: {}.'.format(', '.join(_local_failed)))
+        else:
+            log.info('all chroot instances updated.')
+
     def buildall(self):
         """
         Build all packages that need to be built.
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""debris.scheduler -- build job scheduler for debris autobuild system."""
+
+__license__ = "BSD-3-Clause"
+__docformat__ = "reStructuredText"
+
+import os
+import threading
+import time
+
+from . import common
+from .metrics import BuildMetrics
+from .common import getconfig
+from .common import log
+
+"seconds between checks while jobs wait for a chroot to become ready."
+CHROOT_POLL_INTERVAL = 5
+
+
+class BuildJob(object):
+    """One unit of work: build one cloned package repo in one chroot.
+
+    .. note::
+        self.state is one of 'pending', 'running', 'done', 'failed',
+        'skipped'.
+
+    Jobs sharing any key in self.locks never run at the same time. By
+    default the key is the working dir, since gbp builds in-tree.
+
+    A job without instance builds the source package only (self.dsc);
+    jobs with self.source_job set build binaries from that .dsc into
+    self.output_dir, and are listed in source_job.pending_binaries
+    until they finish.
+
+    A job only starts after every job in self.depends is done; if any of
+    them failed or got skipped, this job is skipped as well. Likewise it
+    waits while its instance is being prepared (instance.ready is False),
+    and is skipped if that preparation failed.
+
+    A job with self.remote set runs on a remote worker (see
+    debris.remote): it does not wait for the local chroot, and does not
+    count against the local worker, chroot, cpu and memory limits.
+
+    self.cost is the estimated wall-clock seconds of the job, see
+    debris.cost.CostModel; it decides the order jobs are started in.
+    """
+
+    def __init__(self, repo, instance, cpus: int = 1, memory: int = 0, locks: list = None):
+        self.repo = repo
+        self.instance = instance
+        self.working_dir = repo.working_dir if repo else None
+        self.cpus = cpus
+        self.memory = memory
+        if locks is None:
+            locks = [self.working_dir]
+        self.locks = set(locks)
+        self.depends = []
+        self.source_job = None
+        self.pending_binaries = []
+        self.dsc = None
+        self.output_dir = None
+        self.package = None
+        self.version = None
+        self.result = None
+        self.log = None
+        self.metrics = BuildMetrics()
+        self.remote = False
+        self.cost = 0
+        self.state = 'pending'
+
+    @property
+    def chroot(self):
+        return self.instance.chroot if self.instance else None
+
+    def __str__(self):
+        return '{}@{}'.format(
+                self.package or os.path.basename(str(self.working_dir)),
+                self.chroot or 'source',
+                )
+
+
+class DebrisScheduler(object):
+    """A small worker pool that runs BuildJob objects concurrently.
+
+    The following limits apply when picking the next job:
+
+      * at most `workers` jobs run at the same time;
+      * at most `chroot_limit` jobs run in one chroot (0 means no limit);
+      * the sum of job.cpus stays within `cpu_budget`;
+      * the sum of job.memory (MiB) stays within `memory_budget` (0 means no limit);
+      * jobs sharing a lock key never overlap.
+
+    Only the lock keys apply to remote jobs.
+
+    Among the jobs that can start, the one with the longest chain of
+    work still behind it (its own cost plus that of the longest path
+    through the jobs depending on it) goes first, so that long builds
+    and the builds they hold up do not end up at the tail of the run.
+
+    `build_func(job)` runs in a worker thread and returns True on success.
+    `on_complete(job)` runs in the thread that called run(), so it is safe
+    to touch non-thread-safe objects (e.g. the sqlite connection) there.
+    """
+
+    def __init__(
+            self,
+            build_func,
+            on_complete=None,
+            workers: int = None,
+            chroot_limit: int = None,
+            cpu_budget: int = None,
+            memory_budget: int = None,
+            ):
+        self.build_func = build_func
+        self.on_complete = on_complete
+        if workers is None:
+            workers = getconfig('DEBRIS_SCHEDULER_WORKERS', int)
+        if chroot_limit is None:
+            chroot_limit = getconfig('DEBRIS_SCHEDULER_CHROOT_LIMIT', int)
+        if cpu_budget is None:
+            cpu_budget = getconfig('DEBRIS_SCHEDULER_CPU_BUDGET', int)
+        if memory_budget is None:
+            memory_budget = getconfig('DEBRIS_SCHEDULER_MEMORY_BUDGET', int)
+        self.workers = max(1, workers)
+        self.chroot_limit = max(0, chroot_limit)
+        self.cpu_budget = cpu_budget if cpu_budget > 0 else (os.cpu_count() or 1)
+        self.memory_budget = max(0, memory_budget)
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._running = []
+        self._finished = []
+        self._held_locks = set()
+        log.debug('new scheduler, workers: {}, chroot limit: {}, cpu budget: {}, memory budget: {}'.format(
+                self.workers,
+                self.chroot_limit,
+                self.cpu_budget,
+                self.memory_budget,
+                ))
+
+    def add(self, job: BuildJob):
+        """Queue one job.
+
+        A job asking for more than the whole budget is clamped, so that
+        it can still run when the pool is otherwise idle.
+        """
+        job.cpus = min(max(1, job.cpus), self.cpu_budget)
+        if self.memory_budget:
+            job.memory = min(max(0, job.memory), self.memory_budget)
+        with self._cond:
+            self._pending.append(job)
+
+    def _fits(self, job: BuildJob, running: list = None, held_locks: set = None) -> bool:
+        """Whether job can start next to the running jobs, by default the real ones."""
+        if running is None:
+            running = self._running
+        if held_locks is None:
+            held_locks = self._held_locks
+        if job.locks & held_locks:
+            return False
+        if job.remote:
+            return True
+        _local_running = [i for i in running if not i.remote]
+        if len(_local_running) >= self.workers:
+            return False
+        if self.chroot_limit and job.chroot:
+            _local_count = len([i for i in _local_running if i.chroot == job.chroot])
+            if _local_count >= self.chroot_limit:
+                return False
+        if sum([i.cpus for i in _local_running]) + job.cpus > self.cpu_budget:
+            return False
+        if self.memory_budget and sum([i.memory for i in _local_running]) + job.memory > self.memory_budget:
+            return False
+        return True
+
+    def _prioritize(self):
+        """Sort the pending jobs by the work still behind them, longest first. Must hold self._cond."""
+        _local_dependents = {}
+        for job in self._pending:
+            for i in job.depends:
+                _local_dependents.setdefault(id(i), []).append(job)
+        _local_levels = {}
+        "job.depends is acyclic, so the recursion ends."
+        def _level(job) -> float:
+            if id(job) not in _local_levels:
+                _local_levels[id(job)] = (job.cost or 0) + max([_level(i) for i in _local_dependents.get(id(job), [])], default=0)
+            return _local_levels[id(job)]
+        self._pending.sort(key=lambda job: -_level(job))
+
+    def estimate(self, remote_slots: int = 0) -> float:
+        """Estimate the wall-clock seconds of running the queued jobs.
+
+        This replays the dispatch order and limits with job.cost as the
+        duration of each job. Remote jobs run on at most `remote_slots`
+        workers at a time (0 means no limit). Waiting for chroots to get
+        ready is not accounted for.
+        """
+        with self._cond:
+            self._prioritize()
+            _local_pending = list(self._pending)
+        _local_end = {}
+        _local_running = []
+        _local_now = 0.0
+        while _local_pending:
+            _local_locks = set().union(*[i.locks for i in _local_running])
+            for job in list(_local_pending):
+                if [i for i in job.depends if id(i) not in _local_end or _local_end[id(i)] > _local_now]:
+                    "also true for dependencies that were never queued; those jobs get skipped."
+                    continue
+                if job.remote and remote_slots and len([i for i in _local_running if i.remote]) >= remote_slots:
+                    continue
+                if not self._fits(job, _local_running, _local_locks):
+                    continue
+                _local_pending.remove(job)
+                _local_running.append(job)
+                _local_locks |= job.locks
+                _local_end[id(job)] = _local_now + (job.cost or 0)
+            if not _local_running:
+                break
+            _local_now = min([_local_end[id(i)] for i in _local_running])
+            _local_running = [i for i in _local_running if _local_end[id(i)] > _local_now]
+        return max(_local_end.values(), default=0.0)
+
+    def _skip(self, job: BuildJob, reason: str):
+        """Give up a pending job without running it. Must hold self._cond."""
+        log.warn('skipping job {}: {}.'.format(job, reason))
+        self._pending.remove(job)
+        job.state = 'skipped'
+        self._finished.append(job)
+
+    def _dispatch(self) -> bool:
+        """Start every pending job that fits. Must hold self._cond.
+
+        Return whether some job is waiting for its chroot to get ready.
+        """
+        _local_waiting = False
+        for job in list(self._pending):
+            _local_broken = [str(i) for i in job.depends if i.state in ('failed', 'skipped')]
+            if _local_broken:
+                self._skip(job, 'dependency {} not built'.format(', '.join(_local_broken)))
+                continue
+            if job.instance is not None and job.instance.ready is False and not job.remote:
+                if getattr(job.instance, 'failed', False):
+                    self._skip(job, 'chroot {} failed to prepare'.format(job.chroot))
+                else:
+                    _local_waiting = True
+                continue
+            if [i for i in job.depends if i.state != 'done']:
+                continue
+            if not self._fits(job):
+                continue
+            self._pending.remove(job)
+            self._running.append(job)
+            self._held_locks |= job.locks
+            job.state = 'running'
+            log.debug('dispatching job {}.'.format(job))
+            threading.Thread(
+                    target=self._worker,
+                    args=(job,),
+                    name='debris-build-{}'.format(job),
+                    daemon=True,
+                    ).start()
+        return _local_waiting
+
+    def _worker(self, job: BuildJob):
+        _local_success = False
+        _local_start = time.monotonic()
+        try:
+            _local_success = bool(self.build_func(job))
+        except Exception as e:
+            log.error('job {} raised exception: {}.'.format(job, str(e)))
+        job.metrics.duration = time.monotonic() - _local_start
+        with self._cond:
+            job.state = 'done' if _local_success else 'failed'
+            self._running.remove(job)
+            self._held_locks -= job.locks
+            self._finished.append(job)
+            self._cond.notify_all()
+
+    def run(self) -> list:
+        """Run all queued jobs, return them once all have finished."""
+        with self._cond:
+            self._prioritize()
+            _local_all_jobs = list(self._pending)
+        log.info('scheduler starting, {} job(s) queued.'.format(len(_local_all_jobs)))
+        while True:
+            with self._cond:
+                _local_waiting = self._dispatch()
+                if _local_waiting:
+                    if not self._finished:
+                        self._cond.wait(CHROOT_POLL_INTERVAL)
+                else:
+                    if not self._running and not self._finished:
+                        for job in list(self._pending):
+                            self._skip(job, 'dependency never scheduled')
+                    while self._running and not self._finished:
+                        self._cond.wait()
+                _local_finished = self._finished
+                self._finished = []
+                _local_idle = not self._running and not self._pending
+            for job in _local_finished:
+                log.info('job {} finished: {}.'.format(job, job.state))
+                if self.on_complete:
+                    try:
+                        self.on_complete(job)
+                    except Exception as e:
+                        log.error('on_complete of job {} raised exception: {}.'.format(job, str(e)))
+            if _local_idle and not _local_finished:
+                break
+        log.info('scheduler finished.')
+        return _local_all_jobs